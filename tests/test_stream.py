@@ -0,0 +1,36 @@
+import numpy as np
+
+from uquake.core import Stream, Trace
+from uquake.core.stream import merge_traces
+
+
+def _segment(offset, npts=10, sampling_rate=10.):
+    trace = Trace(data=np.arange(npts, dtype=np.float64),
+                  header={'network': 'XX', 'station': 'A', 'channel': 'Z',
+                          'sampling_rate': sampling_rate})
+    trace.stats.starttime += offset
+
+    return trace
+
+
+def test_merge_contiguous_segments_updates_header():
+    first = _segment(0)
+    second = _segment(1)
+
+    merged = merge_traces([first, second])
+
+    assert merged.stats.npts == 20
+    assert len(merged.data) == 20
+    assert merged.stats.starttime == first.stats.starttime
+    assert merged.stats.endtime == second.stats.endtime
+    np.testing.assert_array_equal(merged.data[10:], second.data)
+
+
+def test_merge_segments_stream_header():
+    stream = Stream(traces=[_segment(1), _segment(0)])
+
+    merged = stream.merge_segments()
+
+    assert len(merged) == 1
+    assert merged[0].stats.npts == 20
+    assert merged[0].stats.endtime - merged[0].stats.starttime == 1.9
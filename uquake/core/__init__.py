@@ -1,3 +1,3 @@
 from .event import read_events, Event, Catalog
-from .stream import read, Stream, Trace
+from .stream import read, read_many, Stream, Trace
 from .inventory import read_inventory
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------
+# Filename: codec.py
+#  Purpose: serialization of streams for in memory transport
+#   Author: uquake development team
+#    Email: devs@uquake.org
+#
+# Copyright (C) 2016 uquake development team
+# --------------------------------------------------------------------
+"""
+serialization of streams for in memory transport
+
+Codecs are registered by name with register_codec and used through
+:meth:`~uquake.core.stream.Stream.to_bytes` and
+:meth:`~uquake.core.stream.Stream.from_bytes`.
+
+:copyright:
+    uquake development team (devs@uquake.org)
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+import json
+import zlib
+from io import BytesIO
+from struct import pack, unpack_from
+
+import numpy as np
+import obspy.core.stream as obsstream
+from obspy import UTCDateTime
+
+from .trace import Trace
+
+CODECS = {}
+
+# the sample blocks of the NUMPY codec are aligned so the decoded arrays are
+# aligned views of the buffer
+ALIGNMENT = 16
+
+
+def register_codec(name, encoder, decoder):
+    """
+    register a codec
+    :param name: name of the codec
+    :type name: str
+    :param encoder: function taking a stream and keyword arguments and
+    returning a bytes-like object
+    :param decoder: function taking a bytes-like object and keyword arguments
+    and returning a list of traces
+    """
+    CODECS[name.upper()] = (encoder, decoder)
+
+
+def _get_codec(codec):
+    codec = codec.upper()
+
+    if codec not in CODECS:
+        raise TypeError(f'codec {codec} is not supported. Supported codecs: '
+                        f'{", ".join(CODECS)}')
+
+    return CODECS[codec]
+
+
+def encode(st, codec='MSEED', **kwargs):
+    encoder, _ = _get_codec(codec)
+
+    return encoder(st, **kwargs)
+
+
+def decode(data, codec='MSEED', **kwargs):
+    _, decoder = _get_codec(codec)
+
+    return decoder(data, **kwargs)
+
+
+def writable_traces(st, format='MSEED'):
+    """
+    traces of a stream that can be handed to the obspy writers without the
+    stream being altered. The MiniSEED writer only replaces the non
+    contiguous data arrays, these traces are replaced by shallow copies
+    holding a contiguous copy of the data and the other traces are returned
+    as is. The writers of the other formats add their own headers to the
+    stats (e.g., stats.segy), every trace is replaced by a copy with its own
+    stats sharing the data.
+    :param st: stream or list of traces
+    :param format: format of the writer
+    :type format: str
+    :rtype: list
+    """
+
+    if format.upper() != 'MSEED':
+        return [Trace(header=tr.stats.copy(), data=tr.data) for tr in st]
+
+    traces = []
+
+    for tr in st:
+        if isinstance(tr.data, np.ndarray) and \
+                not tr.data.flags.c_contiguous:
+            tr = Trace(header=tr.stats.copy(),
+                       data=np.ascontiguousarray(tr.data))
+        traces.append(tr)
+
+    return traces
+
+
+def encode_mseed(st, **kwargs):
+    buf = BytesIO()
+    # the MiniSEED writer replaces non contiguous data arrays, only the
+    # traces it would alter are copied
+    obsstream.Stream.write(obsstream.Stream(traces=writable_traces(st)), buf,
+                           format='MSEED', **kwargs)
+
+    return buf.getvalue()
+
+
+def decode_mseed(data, **kwargs):
+    from .stream import read
+
+    return read(BytesIO(data), format='MSEED', **kwargs).traces
+
+
+def encode_numpy(st, **kwargs):
+    """
+    encode the samples as raw bytes preceded by a json header containing the
+    stats, dtype and position of every trace
+
+    layout: header length (uint64, little endian) | json header | padding |
+    sample blocks, each aligned on ALIGNMENT bytes
+    """
+
+    headers = []
+    blocks = []
+    position = 0
+
+    for tr in st:
+        data = np.ascontiguousarray(tr.data)
+        headers.append({'stats': tr.stats_to_json(),
+                        'dtype': data.dtype.str,
+                        'npts': len(data),
+                        'offset': position})
+        blocks.append(data)
+        position += _aligned(data.nbytes)
+
+    header = json.dumps(headers, default=str).encode('utf-8')
+    start = _aligned(8 + len(header))
+
+    buf = bytearray(start + position)
+    buf[:8] = pack('<Q', len(header))
+    buf[8:8 + len(header)] = header
+
+    for header_tr, data in zip(headers, blocks):
+        offset = start + header_tr['offset']
+        buf[offset:offset + data.nbytes] = memoryview(data).cast('B')
+
+    return buf
+
+
+def decode_numpy(data, **kwargs):
+    """
+    decode data encoded with encode_numpy. The traces data are views of the
+    buffer, they are writable only if the buffer is (e.g., bytearray).
+    """
+
+    header_length = unpack_from('<Q', data)[0]
+    headers = json.loads(bytes(data[8:8 + header_length]).decode('utf-8'))
+    start = _aligned(8 + header_length)
+
+    traces = []
+
+    for header_tr in headers:
+        stats = header_tr['stats']
+        stats['starttime'] = UTCDateTime(stats['starttime'])
+        stats.pop('endtime', None)
+        samples = np.frombuffer(data, dtype=np.dtype(header_tr['dtype']),
+                                count=header_tr['npts'],
+                                offset=start + header_tr['offset'])
+        traces.append(Trace(header=stats, data=samples))
+
+    return traces
+
+
+def encode_numpy_zlib(st, level=1, **kwargs):
+    return zlib.compress(encode_numpy(st), level)
+
+
+def decode_numpy_zlib(data, **kwargs):
+    # the decompressed buffer is owned by the traces, the views are writable
+    return decode_numpy(bytearray(zlib.decompress(data)))
+
+
+def _aligned(nbytes):
+    return -(-nbytes // ALIGNMENT) * ALIGNMENT
+
+
+register_codec('MSEED', encode_mseed, decode_mseed)
+register_codec('NUMPY', encode_numpy, decode_numpy)
+register_codec('NUMPY_ZLIB', encode_numpy_zlib, decode_numpy_zlib)
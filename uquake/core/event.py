@@ -29,6 +29,7 @@ from copy import deepcopy
 from base64 import b64encode, b64decode
 from io import BytesIO
 import pickle
+from uquake.waveform import mag_utils
 from uquake.waveform.mag_utils import calc_static_stress_drop
 
 debug = False
@@ -129,6 +130,77 @@ class Catalog(obsevent.Catalog):
     def copy(self):
         return deepcopy(self)
 
+    def source_properties(self, **kwargs):
+        """
+        return the source properties of the preferred magnitude (the last
+        magnitude if none is preferred) of every event computed for all the
+        events at once. The properties derived from the magnitude are
+        computed for the Mw magnitudes only, they are nan for the others.
+        :param kwargs: see uquake.waveform.mag_utils.source_properties
+        :return: table indexed by the event resource ids with the columns
+        mag, magnitude_type, corner_frequency_hz, energy_joule,
+        seismic_moment, potency_m3, apparent_stress and
+        static_stress_drop_mpa
+        :rtype: pandas.DataFrame
+        """
+        import pandas as pd
+
+        fields = ('mag', 'corner_frequency_hz', 'energy_joule')
+        values = np.full((len(self.events), len(fields)), np.nan)
+        magnitude_types = []
+
+        for k, event in enumerate(self.events):
+            magnitude = None
+
+            if event.magnitudes:
+                # the preferred magnitude is looked up in the magnitudes of
+                # the event rather than through the resource identifier
+                preferred = getattr(event.preferred_magnitude_id, 'id',
+                                    None)
+                magnitude = event.magnitudes[-1]
+
+                for candidate in event.magnitudes:
+                    if candidate.resource_id.id == preferred:
+                        magnitude = candidate
+                        break
+
+            if magnitude is None:
+                magnitude_types.append(None)
+                continue
+
+            # the fields are read directly, not through the properties
+            attributes = magnitude.__dict__
+            magnitude_types.append(attributes.get('magnitude_type'))
+
+            for j, field in enumerate(fields):
+                value = attributes.get(field)
+
+                if value is not None:
+                    values[k, j] = value
+
+        magnitude_types = np.array(magnitude_types, dtype=object)
+        mag, corner_frequency, energy = values.T
+        # the catalog values are kept, only the derived columns are nan for
+        # the magnitudes other than Mw
+        moment_magnitude = np.where(magnitude_types == 'Mw', mag, np.nan)
+
+        table = pd.DataFrame({'mag': mag, 'magnitude_type': magnitude_types,
+                              'corner_frequency_hz': corner_frequency,
+                              'energy_joule': energy},
+                             index=[event.resource_id.id
+                                    for event in self.events])
+
+        properties = mag_utils.source_properties(moment_magnitude,
+                                                 fc=corner_frequency,
+                                                 energy=energy, **kwargs)
+
+        for key, value in properties.items():
+            table[key] = value
+
+        table.index.name = 'event_id'
+
+        return table
+
 
 class Event(obsevent.Event):
 
@@ -183,8 +255,24 @@ class Event(obsevent.Event):
 
         return obsevent.Event.write(self, fileobj, **kwargs)
 
-    def plot_focal_mechanism(self):
-        pass
+    def plot_focal_mechanism(self, **kwargs):
+        """
+        plot the beach ball of the preferred focal mechanism (see
+        uquake.waveform.focal_mechanism)
+        :param kwargs: see obspy.imaging.beachball.beachball
+        :rtype: matplotlib.figure.Figure
+        """
+        from obspy.imaging.beachball import beachball
+
+        focal_mechanism = self.preferred_focal_mechanism() or \
+            (self.focal_mechanisms[-1] if self.focal_mechanisms else None)
+
+        if focal_mechanism is None or focal_mechanism.nodal_planes is None:
+            raise ValueError('the event has no focal mechanism')
+
+        plane = focal_mechanism.nodal_planes.nodal_plane_1
+
+        return beachball([plane.strike, plane.dip, plane.rake], **kwargs)
 
 
 class Origin(obsevent.Origin):
@@ -211,7 +299,11 @@ class Origin(obsevent.Origin):
                 return self.__decode_rays__(self)
 
         else:
-            return self.__dict__[item]
+            # AttributeError so copy and pickle find the missing attributes
+            try:
+                return self.__dict__[item]
+            except KeyError:
+                raise AttributeError(item)
 
     @staticmethod
     def __encode_rays__(self, rays):
@@ -360,14 +452,15 @@ class Magnitude(obsevent.Magnitude):
         app_stress = None
         if self.magnitude_type == 'Mw':
             if self.energy_joule and self.mag:
-                app_stress = 2 * self.energy_joule / self.potency_m3
+                app_stress = float(mag_utils.apparent_stress(
+                    self.energy_joule, self.mag))
         return app_stress
 
     @property
     def seismic_moment(self):
         seismic_moment = None
         if self.magnitude_type == 'Mw':
-            seismic_moment = 10 ** (3 * (self.mag + 6.02) / 2)
+            seismic_moment = float(mag_utils.seismic_moment(self.mag))
         return seismic_moment
 
     # @seismic_moment.setter
@@ -378,10 +471,9 @@ class Magnitude(obsevent.Magnitude):
     @property
     def potency_m3(self):
         potency = None
-        mu = 29.5e9
         if self.magnitude_type == 'Mw':
             if self.mag:
-                potency = self.seismic_moment / mu
+                potency = float(mag_utils.potency(self.mag))
         return potency
 
     def __str__(self, **kwargs):
@@ -450,8 +542,9 @@ class Pick(obsevent.Pick):
     @property
     def sensor(self):
         if self.waveform_id is not None:
-            sensor = self.waveform_id.station_code + \
-                     self.waveform_id.location_code
+            # the codes of a WaveformStreamID default to None
+            sensor = (self.waveform_id.station_code or '') + \
+                     (self.waveform_id.location_code or '')
             return sensor
 
 
@@ -721,7 +814,11 @@ class RayCollection:
         if item == 'rays':
             return self.__decode_rays__(self)
         else:
-            return self.__dict__[item]
+            # AttributeError so copy and pickle find the missing attributes
+            try:
+                return self.__dict__[item]
+            except KeyError:
+                raise AttributeError(item)
 
     @staticmethod
     def __encode_rays__(self, rays):
@@ -16,15 +16,22 @@ Expansion of the obspy.core.stream module
     GNU Lesser General Public License, Version 3
     (http://www.gnu.org/copyleft/lesser.html)
 """
+import bz2
+import gzip
+import lzma
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from io import BytesIO
 
 import numpy as np
 import obspy.core.stream as obsstream
 from pkg_resources import load_entry_point
 
-from .trace import Trace
+from .logging import logger
+from .trace import LazyTrace, Trace
 from .util import ENTRY_POINTS, tools
+from .util.base import wf_entry_points
 
 
 class Stream(obsstream.Stream, ABC):
@@ -55,16 +62,46 @@ class Stream(obsstream.Stream, ABC):
 
         return composite_traces(self)
 
-    def as_array(self, wlen_sec=None, taplen=0.05):
+    def as_array(self, wlen_sec=None, taplen=0.05, sampling_rate=None,
+                 method='polyphase', out=None, return_ids=False):
+        """
+        return the traces as a 2-D array on a common time grid
+        :param wlen_sec: length of the array in second, the extent of the
+        stream if None
+        :param taplen: length of the taper as a fraction of the array length
+        :param sampling_rate: sampling rate of the array, the highest sampling
+        rate of the stream if None. Traces sampled at another rate are
+        resampled.
+        :param method: resampling method, 'polyphase' or 'fft'
+        :param out: preallocated array of shape (len(self), npts) reused
+        instead of allocating a new array
+        :param return_ids: if True the id of the trace of every row is also
+        returned
+        :return: the array, the sampling rate, the time of the first sample
+        and, if return_ids, the id of the trace of every row
+        :rtype: tuple(numpy.ndarray, float, ~obspy.UTCDateTime[, list])
+        """
         t0 = np.min([tr.stats.starttime for tr in self])
-        sr = self[0].stats.sampling_rate
+
+        if sampling_rate is None:
+            sampling_rate = np.max([tr.stats.sampling_rate for tr in self])
+        sr = sampling_rate
 
         if wlen_sec is not None:
             npts_fix = int(wlen_sec * sr)
         else:
-            npts_fix = int(np.max([len(tr.data) for tr in self]))
+            npts_fix = int(np.max([
+                (tr.stats.starttime - t0) * sr +
+                tr.stats.npts * sr / tr.stats.sampling_rate for tr in self])
+                + 0.5)
+
+        data = tools.stream_to_array(self, t0, npts_fix, taplen=taplen,
+                                     sampling_rate=sr, method=method, out=out)
+
+        if return_ids:
+            return data, sr, t0, [tr.id for tr in self]
 
-        return tools.stream_to_array(self, t0, npts_fix, taplen=taplen), sr, t0
+        return data, sr, t0
 
     def chan_groups(self):
         chanmap = self.channel_map()
@@ -80,52 +117,111 @@ class Stream(obsstream.Stream, ABC):
 
         return chanmap
 
-    def write(self, filename, format='MSEED', **kwargs):
+    def write(self, filename, format='MSEED', compression_level=6,
+              workers=None, **kwargs):
 
         from six import string_types
-        f = filename
+        from .codec import writable_traces
+
+        if isinstance(filename, string_types) and filename.endswith('zip'):
+            raise ValueError('Zip protocol is not supported')
+
+        # the MiniSEED writer only replaces the non contiguous data arrays,
+        # the other writers add their headers to the stats (see
+        # uquake.core.codec.writable_traces)
+        st = Stream(traces=writable_traces(self, format=format))
 
         if isinstance(filename, string_types):
-            if filename.endswith('gz'):
-                import gzip
-                f = gzip.open(filename, 'w')
-            elif filename.endswith('bz2'):
-                import bz2
-                f = bz2.BZ2File(filename, 'w')
-            elif filename.endswith('zip'):
-                print('Zip protocol is not supported')
+            extension = filename.split('.')[-1]
 
-        st_out = self.copy()
+            if extension in COMPRESSORS:
+                return _write_compressed(st, filename, extension,
+                                         format=format,
+                                         compression_level=compression_level,
+                                         workers=workers, **kwargs)
 
-        return obsstream.Stream.write(st_out, f, format, **kwargs)
+        return obsstream.Stream.write(st, filename, format, **kwargs)
 
     write.__doc__ = obsstream.Stream.write.__doc__.replace('obspy',
-                                                           'microquake')
+                                                           'microquake') + \
+        """
+        Files with a gz, bz2, xz or lzma extension are compressed, the
+        compression level is set with compression_level. For the MSEED format
+        the traces are encoded and compressed in parallel on workers threads
+        (workers sets the number of threads).
+        """
 
     def write_bytes(self):
-        buf = BytesIO()
-        self.write(buf, format='MSEED')
+        return self.to_bytes(codec='MSEED')
+
+    def to_bytes(self, codec='MSEED', **kwargs):
+        """
+        serialize the stream for in memory transport without copying it
+        :param codec: name of a codec registered in uquake.core.codec, 'MSEED',
+        'NUMPY' (raw samples with a json header) or 'NUMPY_ZLIB'
+        :type codec: str
+        :param kwargs: additional keyword arguments passed to the encoder
+        :rtype: bytes-like object
+        """
+        from .codec import encode
 
-        return buf.getvalue()
+        return encode(self, codec=codec, **kwargs)
+
+    @staticmethod
+    def from_bytes(data, codec='MSEED', **kwargs):
+        """
+        deserialize a stream serialized with to_bytes. With the NUMPY codec
+        the traces data are views of the input buffer (read-only if the buffer
+        is a bytes object), with the NUMPY_ZLIB codec they are views of the
+        decompressed buffer.
+        :param data: serialized stream
+        :type data: bytes-like object
+        :param codec: codec used to serialize the stream
+        :type codec: str
+        :rtype: ~uquake.core.stream.Stream
+        """
+        from .codec import decode
+
+        return Stream(traces=decode(data, codec=codec, **kwargs))
 
     def valid(self, **kwargs):
         return is_valid(self, return_stream=True)
 
     def concat(self, comp_st):
+        """
+        append the traces of the stream to the matching traces of comp_st,
+        the gaps are filled with zeros. If comp_st is None, the segments of
+        the stream are merged.
+        :param comp_st: stream to which the traces are appended
+        :type comp_st: ~uquake.core.stream.Stream
+        :rtype: ~uquake.core.stream.Stream
+        """
 
-        c = (comp_st is not None)
+        if comp_st is None:
+            return self.merge_segments(method='fill', fill_value=0)
 
-        if c:
-            for i, (t1, t2) in enumerate(zip(comp_st.traces, self.traces)):
-                self.detrend_norm(t2)
-                comp_st.traces[i] = t1.__add__(t2, method=1, fill_value=0)
-        else:
-            for t in self:
-                self.detrend_norm(t)
+        return Stream(traces=comp_st.traces + self.traces).merge_segments(
+            method='fill', fill_value=0)
+
+    def merge_segments(self, method='fill', fill_value=0, overlap='last'):
+        """
+        merge the segments of every channel in one pass. The segments are
+        sorted, the extent of the output is computed once and every segment
+        is copied once in a preallocated buffer. This is much faster than
+        Stream.merge when merging many short segments (e.g., telemetry
+        packets). See merge_traces for the description of the parameters.
+        :rtype: ~uquake.core.stream.Stream
+        """
+
+        groups = {}
 
-            comp_st = self
+        for tr in self:
+            groups.setdefault((tr.id, tr.stats.sampling_rate), []).append(tr)
 
-        return comp_st
+        return Stream(traces=[merge_traces(traces, method=method,
+                                           fill_value=fill_value,
+                                           overlap=overlap)
+                              for traces in groups.values()])
 
     def sorted_sta_codes(self):
         sorted_list = sorted(self.unique_stations().astype(int))
@@ -245,11 +341,18 @@ class Stream(obsstream.Stream, ABC):
 
         return Stream(traces=traces)
 
-    def to_traces_json(self):
+    def to_traces_json(self, encoding=None, compression=None,
+                       compression_level=6):
+        """
+        return a list of json serializable representations of the traces,
+        see :meth:`~uquake.core.trace.Trace.to_json` for the description of
+        the parameters
+        """
         traces = []
 
         for tr in self:
-            trout = tr.to_json()
+            trout = tr.to_json(encoding=encoding, compression=compression,
+                               compression_level=compression_level)
             traces.append(trout)
 
         return traces
@@ -265,6 +368,66 @@ class Stream(obsstream.Stream, ABC):
 # st = st.composite()
 
 
+# compressors by file extension, each returns a complete compressed member
+# and concatenated members form a valid compressed file
+COMPRESSORS = {'gz': lambda data, level: gzip.compress(data, level),
+               'bz2': lambda data, level: bz2.compress(data, level),
+               'xz': lambda data, level: lzma.compress(data, preset=level),
+               'lzma': lambda data, level: lzma.compress(
+                   data, format=lzma.FORMAT_ALONE, preset=level)}
+
+# minimum number of bytes of samples compressed as one member
+COMPRESSION_CHUNK_BYTES = 2 ** 20
+
+
+def _write_compressed(st, filename, extension, format='MSEED',
+                      compression_level=6, workers=None, **kwargs):
+    """
+    write a compressed file. For the MSEED format, groups of traces are
+    encoded and compressed as independent members on worker threads and
+    written in order as they are ready. The compressors of the standard
+    library release the GIL. The traces are handed to the writers as is (see
+    uquake.core.codec.writable_traces).
+    """
+
+    compress = COMPRESSORS[extension]
+
+    if format.upper() != 'MSEED':
+        buf = BytesIO()
+        obsstream.Stream.write(st, buf, format, **kwargs)
+
+        with open(filename, 'wb') as f_out:
+            f_out.write(compress(buf.getvalue(), compression_level))
+
+        return
+
+    def encode(traces):
+        buf = BytesIO()
+        obsstream.Stream.write(Stream(traces=traces), buf, format='MSEED',
+                               **kwargs)
+
+        return compress(buf.getvalue(), compression_level)
+
+    # lzma alone format does not support concatenated members
+    if extension == 'lzma':
+        chunks = [st.traces]
+    else:
+        chunks = [[]]
+        chunk_bytes = 0
+
+        for tr in st:
+            if chunk_bytes >= COMPRESSION_CHUNK_BYTES:
+                chunks.append([])
+                chunk_bytes = 0
+            chunks[-1].append(tr)
+            chunk_bytes += tr.data.nbytes
+
+    with open(filename, 'wb') as f_out, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        for member in executor.map(encode, chunks):
+            f_out.write(member)
+
+
 def is_valid(st_in, return_stream=False, STA=0.005, LTA=0.1, min_num_valid=5):
     """
         Determine if an event is valid or return valid traces in a  stream
@@ -368,6 +531,103 @@ def check_for_dead_trace(tr):
         return 0
 
 
+def merge_traces(traces, method='fill', fill_value=0, overlap='last'):
+    """
+    merge segments of a single channel into one trace. The segments are
+    placed on the sample grid of the earliest segment.
+    :param traces: segments with the same id and sampling rate
+    :type traces: list of ~uquake.core.trace.Trace
+    :param method: gap policy, 'fill' fills the gaps with fill_value,
+    'interpolate' interpolates linearly across the gaps and 'mask' returns a
+    masked array with the gaps masked
+    :type method: str
+    :param fill_value: value used to fill the gaps with method='fill'
+    :param overlap: samples kept where segments overlap, 'last' keeps the
+    samples of the segment starting last, 'first' the samples already in
+    place
+    :type overlap: str
+    :rtype: ~uquake.core.trace.Trace
+    """
+
+    if method not in ('fill', 'interpolate', 'mask'):
+        raise ValueError(f'unknown method {method}, expected one of fill, '
+                         f'interpolate or mask')
+
+    if overlap not in ('first', 'last'):
+        raise ValueError(f'unknown overlap {overlap}, expected first or last')
+
+    if method == 'fill' and fill_value is None:
+        method = 'mask'
+
+    traces = sorted(traces, key=lambda tr: tr.stats.starttime)
+
+    if len(traces) == 1 and not np.ma.isMaskedArray(traces[0].data):
+        return traces[0].copy()
+
+    sampling_rate = traces[0].stats.sampling_rate
+    t0 = traces[0].stats.starttime
+    offsets = np.array([int(round((tr.stats.starttime - t0) * sampling_rate))
+                        for tr in traces])
+    ends = offsets + np.array([len(tr.data) for tr in traces])
+    npts = int(ends.max())
+
+    dtype = np.result_type(*[tr.data.dtype for tr in traces])
+
+    if method == 'interpolate':
+        dtype = np.result_type(dtype, np.float32)
+    elif method == 'fill':
+        dtype = np.result_type(dtype, np.min_scalar_type(fill_value))
+
+    data = np.empty(npts, dtype=dtype)
+    mask = None
+    gaps = []
+    covered = 0
+
+    for tr, offset, end in zip(traces, offsets, ends):
+        if offset > covered:
+            gaps.append((covered, offset))
+
+        if overlap == 'first':
+            start = max(offset, covered)
+        else:
+            start = offset
+
+        if end > start:
+            data[start:end] = np.ma.getdata(tr.data)[start - offset:]
+
+            if np.ma.isMaskedArray(tr.data) and np.ma.is_masked(tr.data):
+                if mask is None:
+                    mask = np.zeros(npts, dtype=bool)
+                mask[start:end] = np.ma.getmaskarray(tr.data)[start - offset:]
+            elif mask is not None:
+                mask[start:end] = False
+
+        covered = max(covered, end)
+
+    for start, end in gaps:
+        if method == 'interpolate':
+            data[start:end] = np.interp(np.arange(start, end),
+                                        [start - 1, end],
+                                        [data[start - 1], data[end]])
+        elif method == 'fill':
+            data[start:end] = fill_value
+        else:
+            data[start:end] = 0
+
+            if mask is None:
+                mask = np.zeros(npts, dtype=bool)
+            mask[start:end] = True
+
+    if mask is not None:
+        data = np.ma.masked_array(data, mask=mask)
+
+    trace = Trace(header=traces[0].stats.copy(), data=data)
+    # Trace keeps the npts of the header, setting the data updates it
+    trace.data = data
+
+    return trace
+
+
 def composite_traces(st_in):
     """
     Requires length and sampling_rates equal for all traces
@@ -409,26 +669,204 @@ def composite_traces(st_in):
     return Stream(traces=trsout)
 
 
-def read(fname, format='MSEED', **kwargs):
-    if format in ENTRY_POINTS['waveform'].keys():
-        format_ep = ENTRY_POINTS['waveform'][format]
-        read_format = load_entry_point(format_ep.dist.key,
-                                       'obspy.plugin.waveform.%s' %
-                                       format_ep.name, 'readFormat')
+def read(fname, format='MSEED', lazy=False, **kwargs):
+    if lazy:
+        return _read_lazy(fname, format=format, **kwargs)
 
-        st = Stream(stream=read_format(fname, **kwargs))
+    return _read_file(_get_read_format(format), fname, format=format,
+                      **kwargs)
 
-        # making sure the channel names are upper case
-        trs = []
-        for tr in st:
-            tr.stats.channel = tr.stats.channel.upper()
-            trs.append(tr.copy())
 
-        st.traces = trs
+read.__doc__ = obsstream.read.__doc__.replace('obspy', 'microquake')
+
+
+def read_many(paths, format='MSEED', workers=None, use_processes=False,
+              errors=None, **kwargs):
+    """
+    read many files concurrently and merge the traces into one Stream. The
+    traces are ordered following the order of the input paths.
+    :param paths: list of paths to the files
+    :type paths: list
+    :param format: format of the files
+    :type format: str
+    :param workers: number of workers, default to the executor default
+    :type workers: int
+    :param use_processes: if True, the files are read in a process pool
+    instead of a thread pool. Processes are better suited to formats whose
+    decoding is done in Python (e.g., IMS_ASCII or TEXCEL_CSV).
+    :type use_processes: bool
+    :param errors: if a dict is provided, the exception raised when reading a
+    file is stored in the dictionary with the path as key and the file is
+    skipped, if None the exception is raised.
+    :type errors: dict
+    :param kwargs: additional keyword arguments passed to the reader
+    :rtype: ~uquake.core.stream.Stream
+    """
+
+    paths = list(paths)
+    streams = {}
+
+    for fname, st in iread_many(paths, format=format, workers=workers,
+                                use_processes=use_processes, errors=errors,
+                                **kwargs):
+        streams[fname] = st
+
+    traces = []
+
+    for fname in paths:
+        if fname in streams:
+            traces += streams[fname].traces
+
+    return Stream(traces=traces)
+
 
-        return st
+def iread_many(paths, format='MSEED', workers=None, use_processes=False,
+               errors=None, **kwargs):
+    """
+    read many files concurrently and yield the (path, Stream) tuples as the
+    files are read, see read_many for the description of the parameters.
+    """
+
+    from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                    as_completed)
+
+    # the plugin is resolved once and shared by all the workers
+    read_format = _get_read_format(format)
+
+    if use_processes:
+        executor = ProcessPoolExecutor(max_workers=workers)
     else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+    with executor:
+        futures = {executor.submit(_read_file, read_format, fname,
+                                   format=format, **kwargs): fname
+                   for fname in paths}
+
+        for future in as_completed(futures):
+            fname = futures[future]
+
+            try:
+                st = future.result()
+            except Exception as e:
+                if errors is None:
+                    raise
+                logger.error(f'could not read {fname}: {e}')
+                errors[fname] = e
+
+                continue
+
+            yield fname, st
+
+
+@lru_cache(maxsize=None)
+def _get_read_format(format):
+    """
+    return the readFormat function of a waveform plugin or None if the
+    format is not registered as a plugin
+    """
+
+    if format not in ENTRY_POINTS['waveform'].keys():
+        return None
+
+    format_ep = ENTRY_POINTS['waveform'][format]
+
+    return load_entry_point(format_ep.dist.key,
+                            'obspy.plugin.waveform.%s' % format_ep.name,
+                            'readFormat')
+
+
+def _read_file(read_format, fname, format='MSEED', **kwargs):
+    if read_format is None:
         return Stream(stream=obsstream.read(fname, format=format, **kwargs))
 
+    st = Stream(stream=read_format(fname, **kwargs))
 
-read.__doc__ = obsstream.read.__doc__.replace('obspy', 'microquake')
+    # making sure the channel names are upper case
+    for tr in st:
+        tr.stats.channel = tr.stats.channel.upper()
+
+    return st
+
+
+def _read_lazy(fname, format='MSEED', **kwargs):
+    """
+    read the headers of a file and return a Stream of LazyTrace. The samples
+    of a trace are only decoded the first time its data attribute is
+    accessed. For MiniSEED files, only the records of the accessed trace are
+    decoded, for the other formats the file is decoded once on the first
+    access and shared between the traces.
+    :param fname: path to the file
+    :param format: file format, only the formats supported by ObsPy can be
+    read lazily
+    :rtype: ~uquake.core.stream.Stream
+    """
+
+    if format in wf_entry_points.keys():
+        logger.warning(f'lazy reading is not supported for the {format} '
+                       f'format, the samples will be read immediately')
+
+        return read(fname, format=format, **kwargs)
+
+    header_st = obsstream.read(fname, format=format, headonly=True, **kwargs)
+    loader = _SampleLoader(fname, header_st, format=format, **kwargs)
+
+    traces = []
+
+    for k, tr in enumerate(header_st):
+        tr.stats.channel = tr.stats.channel.upper()
+        traces.append(LazyTrace(header=tr.stats, loader=loader, index=k))
+
+    return Stream(traces=traces)
+
+
+class _SampleLoader(object):
+    """
+    read on demand the samples of the traces of a file read with
+    read(lazy=True)
+    """
+
+    def __init__(self, fname, header_st, format='MSEED', **kwargs):
+        self.fname = fname
+        self.format = format
+        self.kwargs = kwargs
+        # the codes of the traces before channel normalization
+        self.ids = [tr.id for tr in header_st]
+        self.starttimes = [tr.stats.starttime for tr in header_st]
+        self.endtimes = [tr.stats.endtime for tr in header_st]
+        self.traces = None
+
+    def load(self, index):
+        if self.format.upper() == 'MSEED':
+            data = self._load_mseed(index)
+
+            if data is not None:
+                return data
+
+        if self.traces is None:
+            self.traces = obsstream.read(self.fname, format=self.format,
+                                         **self.kwargs).traces
+
+        # releasing the reference so the memory is freed with the trace
+        tr = self.traces[index]
+        self.traces[index] = None
+
+        return tr.data
+
+    def _load_mseed(self, index):
+        """
+        decode only the records of one trace using the libmseed selection
+        """
+        kwargs = {key: value for key, value in self.kwargs.items()
+                  if key not in ['starttime', 'endtime', 'sourcename']}
+        starttime = self.starttimes[index]
+
+        st = obsstream.read(self.fname, format='MSEED',
+                            sourcename=self.ids[index], starttime=starttime,
+                            endtime=self.endtimes[index], **kwargs)
+
+        for tr in st:
+            if abs(tr.stats.starttime - starttime) < tr.stats.delta / 2:
+                return tr.data
+
+        return None
@@ -17,6 +17,8 @@ Expansion of the obspy.core.trace module
     (http://www.gnu.org/copyleft/lesser.html)
 """
 
+from base64 import b64decode, b64encode
+
 import numpy as np
 import obspy.core.trace as obstrace
 from obspy import UTCDateTime
@@ -31,9 +33,11 @@ class Trace(obstrace.Trace):
     def __init__(self, trace=None, **kwargs):
         super(Trace, self).__init__(**kwargs)
 
-        if trace:
+        if trace is not None:
             self.stats = trace.stats
-            self.data = trace.data
+            # set data without changing npts in stats object (for headonly
+            # option)
+            super(obstrace.Trace, self).__setattr__('data', trace.data)
 
     @property
     def sr(self):
@@ -96,23 +100,162 @@ class Trace(obstrace.Trace):
         trace_json_object['stats']['starttime'] = UTCDateTime(trace_json_object['stats']['starttime'])
         trace_json_object['stats']['endtime'] = UTCDateTime(trace_json_object['stats']['endtime'])
 
-        trc = Trace(header=trace_json_object['stats'], data=np.array(trace_json_object['data'], dtype='float32'))
+        if 'data_encoding' in trace_json_object:
+            data = decode_data(trace_json_object['data'], trace_json_object['data_encoding'])
+        else:
+            data = np.array(trace_json_object['data'], dtype='float32')
+
+        trc = Trace(header=trace_json_object['stats'], data=data)
 
         return trc
 
-    def to_json(self):
-        trace_dict = dict()
-        trace_dict['stats'] = dict()
+    def stats_to_json(self):
+        stats = dict()
 
         for key in self.stats.keys():
             if isinstance(self.stats[key], UTCDateTime):
-                # trace_dict['stats'][key] = int(np.float64(self.stats[key].timestamp) * 1e9)
-                trace_dict['stats'][key] = self.stats[key].isoformat()
+                # stats[key] = int(np.float64(self.stats[key].timestamp) * 1e9)
+                stats[key] = self.stats[key].isoformat()
             elif isinstance(self.stats[key], AttribDict):
-                trace_dict['stats'][key] = self.stats[key].__dict__
+                stats[key] = self.stats[key].__dict__
             else:
-                trace_dict['stats'][key] = self.stats[key]
+                stats[key] = self.stats[key]
 
-        trace_dict['data'] = self.data.tolist()
+        return stats
+
+    def to_json(self, encoding=None, compression=None, compression_level=6):
+        """
+        return a json serializable representation of the trace
+        :param encoding: encoding of the samples, if None the samples are
+        written as a list of numbers, if 'base64' the raw bytes of the samples
+        are written as a base64 string. The dtype and shape required to decode
+        the samples are stored under the 'data_encoding' key.
+        :type encoding: str
+        :param compression: compression applied to the raw bytes before the
+        base64 encoding, one of 'zlib', 'bz2', 'lzma' or None
+        :type compression: str
+        :param compression_level: compression level (not used by lzma)
+        :type compression_level: int
+        :rtype: dict
+        """
+        trace_dict = dict()
+        trace_dict['stats'] = self.stats_to_json()
+
+        if encoding is None:
+            trace_dict['data'] = self.data.tolist()
+        elif encoding == 'base64':
+            trace_dict['data'], trace_dict['data_encoding'] = encode_data(
+                self.data, compression=compression, compression_level=compression_level)
+        else:
+            raise ValueError(f'unknown encoding {encoding}')
 
         return trace_dict
+
+
+def _compressor(compression):
+    import bz2
+    import lzma
+    import zlib
+
+    compressors = {'zlib': zlib, 'bz2': bz2, 'lzma': lzma}
+
+    if compression not in compressors:
+        raise ValueError(f'unknown compression {compression}, expected one of '
+                         f'{", ".join(compressors)}')
+
+    return compressors[compression]
+
+
+def encode_data(data, compression=None, compression_level=6):
+    """
+    encode an array as a base64 string of its raw bytes
+    :param data: array to encode
+    :type data: numpy.ndarray
+    :param compression: one of 'zlib', 'bz2', 'lzma' or None
+    :param compression_level: compression level (not used by lzma)
+    :return: the encoded string and the information required to decode it
+    :rtype: tuple(str, dict)
+    """
+    data = np.ascontiguousarray(data)
+    raw = data.tobytes()
+
+    if compression == 'lzma':
+        raw = _compressor(compression).compress(raw)
+    elif compression is not None:
+        raw = _compressor(compression).compress(raw, compression_level)
+
+    data_encoding = {'encoding': 'base64',
+                     'dtype': data.dtype.str,
+                     'shape': list(data.shape),
+                     'compression': compression}
+
+    return b64encode(raw).decode('ascii'), data_encoding
+
+
+def decode_data(encoded, data_encoding):
+    """
+    decode an array encoded with encode_data
+    :param encoded: base64 string
+    :param data_encoding: dictionary returned by encode_data
+    :rtype: numpy.ndarray
+    """
+    raw = b64decode(encoded)
+
+    if data_encoding.get('compression') is not None:
+        raw = _compressor(data_encoding['compression']).decompress(raw)
+
+    # bytearray makes the array writable
+    return np.frombuffer(bytearray(raw), dtype=np.dtype(data_encoding['dtype'])).reshape(data_encoding['shape'])
+
+
+class LazyTrace(Trace):
+    """
+    Trace built from the header only. The samples are read from the file the
+    first time the data attribute is accessed. See
+    :func:`~uquake.core.stream.read` with lazy=True.
+    """
+
+    def __init__(self, header=None, loader=None, index=0):
+        super(LazyTrace, self).__init__(header=header)
+        self._loader = loader
+        self._index = index
+
+    @property
+    def data(self):
+        if self._loader is not None:
+            loader = self._loader
+            self._loader = None
+            self.data = loader.load(self._index)
+
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        # called through obspy.core.trace.Trace.__setattr__, npts is
+        # already updated at this point
+        self.__dict__['_data'] = value
+        self.__dict__['_loader'] = None
+
+    @property
+    def loaded(self):
+        return self._loader is None
+
+    def __len__(self):
+        if not self.loaded:
+            return self.stats.npts
+
+        return len(self.data)
+
+    def __str__(self, id_length=None):
+        if self.loaded:
+            return super(LazyTrace, self).__str__(id_length=id_length)
+
+        # obspy checks the data for masked values, the summary is built on
+        # the empty placeholder array so the samples are not read
+        loader = self._loader
+        self.__dict__['_loader'] = None
+
+        try:
+            return super(LazyTrace, self).__str__(id_length=id_length)
+        finally:
+            self.__dict__['_loader'] = loader
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------
+# Filename: spectral.py
+#  Purpose: spectral operations on real signals using real FFTs
+#   Author: uquake development team
+#    Email: devs@uquake.org
+#
+# Copyright (C) 2016 uquake development team
+# --------------------------------------------------------------------
+"""
+spectral operations on real signals using real FFTs
+
+The functions operate along the last axis and accept 1-D signals or 2-D
+arrays of signals (one signal per row). Only the non-negative frequencies are
+computed, the mirrored half of the spectrum is never built.
+
+:copyright:
+    uquake development team (devs@uquake.org)
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+from functools import lru_cache
+
+import numpy as np
+from scipy import fft as sp_fft
+
+
+def fast_length(npts):
+    """
+    return the smallest length greater or equal to npts for which the FFT is
+    efficient (product of small primes)
+    """
+    return sp_fft.next_fast_len(int(npts), real=True)
+
+
+def rfft(a, n=None, workers=None):
+    """
+    FFT of real signals along the last axis, see scipy.fft.rfft
+    :param a: signal or array of signals
+    :param n: length of the transform, the signals are zero padded or
+    truncated to n samples
+    :param workers: number of workers used to transform the rows of a 2-D
+    array in parallel
+    """
+    return sp_fft.rfft(a, n=n, axis=-1, workers=workers)
+
+
+def irfft(fa, n, workers=None):
+    """
+    inverse of rfft, n is the length of the output signals
+    """
+    return sp_fft.irfft(fa, n=n, axis=-1, workers=workers)
+
+
+def rfftfreq(npts, sr):
+    return sp_fft.rfftfreq(npts, d=1. / sr)
+
+
+@lru_cache(maxsize=128)
+def _freq_window(cf, npts, sr):
+    nfreq = int(npts // 2 + 1)
+    fsr = npts / sr
+    cx = (np.array(cf, dtype=float) * fsr + 0.5).astype(int)
+
+    win = np.zeros(nfreq, dtype=np.float32)
+    win[cx[0]:cx[1]] = taper_cosine(cx[1] - cx[0])
+    win[cx[1]:cx[2]] = 1
+    win[cx[2]:cx[3]] = taper_cosine(cx[3] - cx[2])[::-1]
+    win[cx[-1]:] = 0
+    win.flags.writeable = False
+
+    return win
+
+
+def freq_window(cf, npts, sr):
+    """
+    window on the non-negative frequencies of a npts samples signal, zero
+    below cf[0] and above cf[3], one between cf[1] and cf[2] and cosine
+    tapers in between. The windows are cached and read-only.
+    :param cf: corner frequencies (f1, f2, f3, f4) in Hz
+    :param npts: number of samples of the signal
+    :param sr: sampling rate in Hz
+    :rtype: numpy.ndarray
+    """
+    return _freq_window(tuple(float(f) for f in cf), int(npts), float(sr))
+
+
+def taper_cosine(wlen):
+    return np.cos(np.linspace(np.pi / 2., np.pi, wlen)) ** 2
+
+
+def phase(fsig):
+    """
+    unit amplitude spectrum with the phase of fsig
+    """
+    amplitude = np.abs(fsig)
+    amplitude[amplitude == 0] = 1
+
+    return fsig / amplitude
+
+
+def whiten(a, cf=None, sr=None, win=None, pad=False, out=None, workers=None):
+    """
+    whiten signals, the amplitude spectrum is replaced by a frequency window
+    and the phase is kept
+    :param a: signal or array of signals
+    :param cf: corner frequencies of the window, see freq_window
+    :param sr: sampling rate, required with cf
+    :param win: frequency window of length npts // 2 + 1 used instead of cf
+    :param pad: if True, the signals are zero padded to a fast FFT length
+    (only with cf)
+    :param out: array in which the result is written, may be a itself
+    :param workers: number of workers for the FFTs
+    :rtype: numpy.ndarray
+    """
+
+    npts = a.shape[-1]
+    nfft = fast_length(npts) if (pad and win is None) else npts
+
+    if win is None:
+        win = freq_window(cf, nfft, sr)
+
+    if len(win) != nfft // 2 + 1:
+        raise ValueError(f'the window has {len(win)} frequencies, expected '
+                         f'{nfft // 2 + 1}')
+
+    fa = rfft(a, n=nfft, workers=workers)
+    fa = phase(fa)
+    fa *= win
+    whitened = irfft(fa, nfft, workers=workers)[..., :npts]
+
+    if out is not None:
+        out[...] = whitened
+
+        return out
+
+    return whitened
+
+
+def cross_correlate(a, b, norm=True, pad=False, phase_only=False,
+                    phat=False, workers=None):
+    """
+    cross-correlate signals along the last axis, a and b are broadcast
+    against each other (e.g., one signal against an array of signals)
+    :param a: reference signal(s)
+    :param b: signal(s)
+    :param norm: if True, normalize by the energy of the signals
+    :param pad: if True, the correlation is linear (2 * npts lags), the FFTs
+    use a fast length of at least 2 * npts. If False, the correlation is
+    circular.
+    :param phase_only: correlate the phase spectra only
+    :param phat: apply the phase transform (PHAT) weighting
+    :param workers: number of workers for the FFTs
+    :return: correlation with the zero lag at the centre (index len // 2)
+    :rtype: numpy.ndarray
+    """
+
+    npts = a.shape[-1]
+    nfft = fast_length(2 * npts) if pad else npts
+
+    fa = rfft(a, n=nfft, workers=workers)
+    fb = rfft(b, n=nfft, workers=workers)
+
+    if phase_only:
+        ccf = np.conj(phase(fa)) * phase(fb)
+    else:
+        ccf = np.conj(fa) * fb
+
+    if phat:
+        ccf /= np.abs(ccf)
+
+    cc = irfft(ccf, nfft, workers=workers)
+
+    if pad:
+        # lags -npts to npts - 1
+        cc = np.concatenate((cc[..., -npts:], cc[..., :npts]), axis=-1)
+    else:
+        cc = np.roll(cc, npts // 2, axis=-1)
+
+    if norm:
+        cc /= np.sqrt(np.sum(a ** 2, axis=-1) *
+                      np.sum(b ** 2, axis=-1))[..., np.newaxis]
+
+    return cc
+
+
+def envelope(a, workers=None):
+    """
+    envelope of signals (amplitude of the analytic signal)
+    """
+
+    npts = a.shape[-1]
+    nfreq = npts // 2 + 1
+
+    analytic = np.zeros(a.shape[:-1] + (npts,), dtype=np.complex128)
+    analytic[..., :nfreq] = rfft(a, workers=workers)
+    analytic[..., 1:(npts + 1) // 2] *= 2
+
+    return np.abs(sp_fft.ifft(analytic, axis=-1, workers=workers))
+
+
+def attenuate(a, sr, dist, Q, vel, gspread=True, workers=None):
+    """
+    apply the attenuation exp(-pi f t*) with t* = dist / (vel * Q) and,
+    optionally, the geometrical spreading 1 / dist
+    """
+
+    npts = a.shape[-1]
+    tstar = dist / (vel * Q)
+    factor = np.exp(-np.pi * rfftfreq(npts, sr) * tstar)
+    out = irfft(rfft(a, workers=workers) * factor, npts, workers=workers)
+
+    if gspread:
+        out /= dist
+
+    return out
+
+
+def band_limited_noise(shape, win, workers=None):
+    """
+    random phase noise with the amplitude spectrum win
+    :param shape: shape of the output, the last dimension is the number of
+    samples
+    :param win: amplitude spectrum of length npts // 2 + 1
+    :rtype: numpy.ndarray
+    """
+
+    npts = shape[-1]
+    size = tuple(shape[:-1]) + (len(win),)
+    phases = np.exp(2j * np.pi * np.random.rand(*size))
+
+    return irfft(phases * win, npts, workers=workers)
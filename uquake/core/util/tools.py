@@ -1,9 +1,12 @@
 from datetime import datetime, timedelta
+from functools import lru_cache
 
 import numpy as np
-from scipy.fftpack import fft, fftfreq, ifft
+from scipy.fftpack import fftfreq, ifft
 from scipy.signal import iirfilter, sosfilt, zpk2sos
 
+from . import spectral
+
 
 def datetime_to_epoch_sec(dtime):
     return (dtime - datetime(1970, 1, 1)) / timedelta(seconds=1)
@@ -110,25 +113,103 @@ def create_composite(sigs, groups):
     return out
 
 
-def stream_to_array(st, t0, npts_fix, taplen=0.05):
-    sr = st[0].stats.sampling_rate
+def stream_to_array(st, t0, npts_fix, taplen=0.05, sampling_rate=None,
+                    method='polyphase', out=None):
+    """
+    write the traces of a stream in the rows of an array on a common time
+    grid starting at t0. Traces sampled at another rate are resampled and
+    fractional start offsets are corrected with a sub-sample shift.
+    :param st: stream
+    :param t0: time of the first sample of the array
+    :type t0: ~obspy.UTCDateTime
+    :param npts_fix: number of samples of the array
+    :param taplen: length of the taper as a fraction of npts_fix
+    :param sampling_rate: sampling rate of the array, the sampling rate of the
+    first trace if None
+    :param method: resampling method, 'polyphase' or 'fft'
+    :param out: preallocated array of shape (len(st), npts_fix), a new float32
+    array is allocated if None
+    :rtype: numpy.ndarray
+    """
+
+    if sampling_rate is None:
+        sampling_rate = st[0].stats.sampling_rate
+
     nsig = len(st)
     taplen_npts = int(npts_fix * taplen)
 
-    data = np.zeros((nsig, npts_fix), dtype=np.float32)
+    if out is None:
+        data = np.zeros((nsig, npts_fix), dtype=np.float32)
+    elif out.shape != (nsig, npts_fix):
+        raise ValueError(f'out has shape {out.shape}, expected '
+                         f'{(nsig, npts_fix)}')
+    else:
+        data = out
+        data.fill(0)
 
     for i, tr in enumerate(st):
-        i0 = int((tr.stats.starttime - t0) * sr + 0.5)
-        sig = tr.data - np.mean(tr.data)
+        sig = resample(tr.data - np.mean(tr.data), tr.stats.sampling_rate,
+                       sampling_rate, method=method)
+
+        if taplen_npts > 0:
+            taper_data(sig, min(taplen_npts, len(sig) // 2))
+
+        offset = (tr.stats.starttime - t0) * sampling_rate
+        i0 = int(np.floor(offset + 1e-6))
+        shift = offset - i0
+
+        if shift > 1e-6:
+            sig = fractional_shift(sig, shift)
+
+        if i0 < 0:
+            sig = sig[-i0:]
+            i0 = 0
 
-        if taplen != 0:
-            taper_data(sig, taplen_npts)
         slen = min(len(sig), npts_fix - i0)
-        data[i, i0: i0 + slen] = sig[:slen]
+
+        if slen > 0:
+            data[i, i0: i0 + slen] = sig[:slen]
 
     return data
 
 
+def resample(sig, sr, sr_out, method='polyphase'):
+    """
+    resample a signal
+    :param sig: signal
+    :param sr: sampling rate of the signal
+    :param sr_out: sampling rate of the output
+    :param method: 'polyphase' (scipy.signal.resample_poly) or 'fft'
+    (scipy.signal.resample)
+    """
+    from fractions import Fraction
+    from scipy import signal
+
+    if sr == sr_out:
+        return np.asarray(sig, dtype=np.float64)
+
+    if method == 'polyphase':
+        ratio = Fraction(sr_out / sr).limit_denominator(1000)
+
+        return signal.resample_poly(sig, ratio.numerator, ratio.denominator)
+    elif method == 'fft':
+        return signal.resample(sig, int(round(len(sig) * sr_out / sr)))
+
+    raise ValueError(f'unknown resampling method {method}')
+
+
+def fractional_shift(sig, shift):
+    """
+    delay a signal by a fraction of sample using a phase shift, the value
+    of output sample k is the value of the signal at k - shift
+    """
+
+    npts = len(sig)
+    phase_shift = np.exp(-2j * np.pi * np.fft.rfftfreq(npts) * shift)
+
+    return np.fft.irfft(np.fft.rfft(sig) * phase_shift, npts)
+
+
 def taper_data(data, wlen):
     tap = hann_half(wlen)
     data[:wlen] *= tap
@@ -158,18 +239,7 @@ def integrate(sig):
 
 def attenuate(sig, sr, dist, Q, vel, gspread=True):
 
-    npts = len(sig)
-    fsig = fft(sig)
-    freqs = fftfreq(npts, d=1. / sr)
-    tstar = dist / (vel * Q)
-    factor = np.exp(-np.pi * np.abs(freqs) * tstar)
-    fsig *= factor
-    sig = np.real(ifft(fsig))
-
-    if gspread:
-        sig /= dist
-
-    return sig
+    return spectral.attenuate(sig, sr, dist, Q, vel, gspread=gspread)
 
 
 def roll_data(data, tts):
@@ -210,87 +280,113 @@ def comb_channels(data, cmap):
     return dstack
 
 
-def bandpass(data, band, sr, corners=4, zerophase=True):
-
-    freqmin, freqmax = band
+@lru_cache(maxsize=256)
+def _filter_design(btype, band, sr, corners):
     fe = 0.5 * sr
-    low = freqmin / fe
-    high = freqmax / fe
+    wn = np.array(band) / fe
 
-    z, p, k = iirfilter(corners, [low, high], btype='band',
-                        ftype='butter', output='zpk')
-    sos = zpk2sos(z, p, k)
+    z, p, k = iirfilter(corners, wn, btype=btype, ftype='butter',
+                        output='zpk')
 
-    if zerophase:
-        firstpass = sosfilt(sos, data)
+    return zpk2sos(z, p, k)
 
-        if len(data.shape) == 1:
-            return sosfilt(sos, firstpass[::-1])[::-1]
-        else:
-            return np.fliplr(sosfilt(sos, np.fliplr(firstpass)))
-    else:
-        return sosfilt(sos, data)
 
+def filter_design(btype, band, sr, corners=4):
+    """
+    return the second order sections of a Butterworth filter. The designs are
+    cached, filtering repeatedly with the same parameters designs the filter
+    once. The returned array is shared between the calls and must not be
+    modified.
+    :param btype: lowpass, highpass, bandpass (or band) or bandstop
+    :param band: corner frequency or (freqmin, freqmax) in Hz
+    :param sr: sampling rate in Hz
+    :param corners: filter order
+    :rtype: numpy.ndarray
+    """
 
-def filter(data, btype, band, sr, corners=4, zerophase=True):
-    # btype: lowpass, highpass, band
+    band = np.atleast_1d(band).astype(float)
+    band = float(band[0]) if len(band) == 1 else tuple(band.tolist())
 
-    fe = 0.5 * sr
-    z, p, k = iirfilter(corners, band / fe, btype=btype,
-                        ftype='butter', output='zpk')
-    sos = zpk2sos(z, p, k)
+    return _filter_design(btype, band, float(sr), int(corners))
+
+
+def sos_filter(data, sos, zerophase=True, axis=-1, inplace=False):
+    """
+    filter an array along an axis (the last by default), all the rows of a
+    2-D array are filtered in a single call
+    :param data: array to filter
+    :param sos: second order sections, see filter_design
+    :param zerophase: if True, filter forward and backward
+    :param axis: axis along which the data are filtered
+    :param inplace: if True, the result is written in data
+    :rtype: numpy.ndarray
+    """
+
+    out = sosfilt(sos, data, axis=axis)
 
     if zerophase:
-        firstpass = sosfilt(sos, data)
+        # the reversed views avoid copying the arrays
+        out = np.flip(out, axis=axis)
+        out = np.flip(sosfilt(sos, out, axis=axis), axis=axis)
 
-        if len(data.shape) == 1:
-            return sosfilt(sos, firstpass[::-1])[::-1]
-        else:
-            return np.fliplr(sosfilt(sos, np.fliplr(firstpass)))
-    else:
-        return sosfilt(sos, data)
+    if inplace:
+        data[...] = out
 
+        return data
 
-def decimate(data_in, sr, factor):
-    data = data_in.copy()
-    fmax = sr / (factor * 2)
-    filter(data, 'lowpass', fmax, sr)
+    return out
 
-    if len(data.shape) == 1:
-        return data[::factor]
-    else:
-        return data[:, ::factor]
 
+def bandpass(data, band, sr, corners=4, zerophase=True, axis=-1,
+             inplace=False):
 
-def norm2d(d):
-    return d / np.max(np.abs(d), axis=1)[:, np.newaxis]
+    sos = filter_design('band', band, sr, corners=corners)
 
+    return sos_filter(data, sos, zerophase=zerophase, axis=axis,
+                      inplace=inplace)
 
-def cross_corr(sig1, sig2, norm=True, pad=False, phase_only=False, phat=False):
-    """Cross-correlate two signals."""
-    pad_len = len(sig1)
 
-    if pad is True:
-        pad_len *= 2
-        # pad_len = signal.next_pow_2(pad_len)
+def filter(data, btype, band, sr, corners=4, zerophase=True, axis=-1,
+           inplace=False):
+    # btype: lowpass, highpass, band
 
-    sig1f = fft(sig1, pad_len)
-    sig2f = fft(sig2, pad_len)
+    sos = filter_design(btype, band, sr, corners=corners)
 
-    if phase_only is True:
-        ccf = np.exp(- 1j * np.angle(sig1f)) * np.exp(1j * np.angle(sig2f))
-    else:
-        ccf = np.conj(sig1f) * sig2f
+    return sos_filter(data, sos, zerophase=zerophase, axis=axis,
+                      inplace=inplace)
 
-    if phat:
-        ccf = ccf / np.abs(ccf)
 
-    cc = np.real(ifft(ccf))
+def decimate(data_in, sr, factor, corners=8, axis=-1):
+    """
+    low-pass filter (zero phase) below 80% of the new Nyquist frequency and
+    keep one sample every factor samples
+    :param data_in: array to decimate, not modified
+    :param sr: sampling rate in Hz
+    :param factor: decimation factor
+    :param corners: order of the anti-alias filter
+    :param axis: axis along which the data are decimated
+    :rtype: numpy.ndarray
+    """
+
+    fmax = 0.8 * sr / (factor * 2)
+    data = filter(data_in, 'lowpass', fmax, sr, corners=corners, axis=axis)
 
-    if norm:
-        cc /= np.sqrt(energy(sig1) * energy(sig2))
+    index = [slice(None)] * data.ndim
+    index[axis] = slice(None, None, factor)
 
-    return np.roll(cc, len(cc) // 2)
+    return data[tuple(index)]
+
+
+def norm2d(d):
+    return d / np.max(np.abs(d), axis=1)[:, np.newaxis]
+
+
+def cross_corr(sig1, sig2, norm=True, pad=False, phase_only=False, phat=False):
+    """Cross-correlate two signals (or arrays of signals along the last
+    axis), see uquake.core.util.spectral.cross_correlate."""
+
+    return spectral.cross_correlate(sig1, sig2, norm=norm, pad=pad,
+                                    phase_only=phase_only, phat=phat)
 
 
 def energy(sig, axis=None):
@@ -302,23 +398,13 @@ def energy_freq(fsig, axis=None):
 
 
 def freq_window(cf, npts, sr):
-    nfreq = int(npts // 2 + 1)
-    fsr = npts / sr
-    cf = np.array(cf, dtype=float)
-    cx = (cf * fsr + 0.5).astype(int)
-
-    win = np.zeros(nfreq, dtype=np.float32)
-    win[:cx[0]] = 0
-    win[cx[0]:cx[1]] = taper_cosine(cx[1] - cx[0])
-    win[cx[1]:cx[2]] = 1
-    win[cx[2]:cx[3]] = taper_cosine(cx[3] - cx[2])[::-1]
-    win[cx[-1]:] = 0
-
-    return win
+    # the window cached by uquake.core.util.spectral is read-only, the
+    # callers get their own copy
+    return spectral.freq_window(cf, npts, sr).copy()
 
 
 def taper_cosine(wlen):
-    return np.cos(np.linspace(np.pi / 2., np.pi, wlen)) ** 2
+    return spectral.taper_cosine(wlen)
 
 
 def phase(sig):
@@ -326,39 +412,30 @@ def phase(sig):
 
 
 def whiten2D(a, freqs, sr):
-    wl = a.shape[1]
-    win = freq_window(freqs, wl, sr)
-    af = fft(a)
-
-    for sx in range(a.shape[0]):
-        whiten_freq(af[sx], win)
-    a[:] = np.real(ifft(af))
+    # all the rows are whitened at once and the result written in a
+    spectral.whiten(a, cf=freqs, sr=sr, out=a)
 
 
 def whiten(sig, win):
     """Whiten signal, modified from MSNoise."""
-    npts = len(sig)
-    nfreq = int(npts // 2 + 1)
 
-    assert(len(win) == nfreq)
-    # fsr = npts / sr
+    return spectral.whiten(sig, win=win)
 
-    fsig = fft(sig)
-    # hl = nfreq // 2
 
-    half = fsig[: nfreq]
-    half = win * phase(half)
-    fsig[: nfreq] = half
-    fsig[-nfreq + 1:] = half[1:].conjugate()[::-1]
+def whiten_freq(fsig, win):
+    """
+    whiten a spectrum in place. fsig is either the output of a real FFT
+    (len(fsig) == len(win)) or a full complex spectrum.
+    """
 
-    return np.real(ifft(fsig))
+    nfreq = len(win)
 
+    if len(fsig) == nfreq:
+        fsig[:] = win * phase(fsig)
 
-def whiten_freq(fsig, win):
-    # npts = len(fsig)
-    # nfreq = int(npts // 2 + 1)
-    nfreq = int(len(fsig) // 2 + 1)
-    assert(len(win) == nfreq)
+        return
+
+    assert(int(len(fsig) // 2 + 1) == nfreq)
     fsig[: nfreq] = win * phase(fsig[: nfreq])
     fsig[-nfreq + 1:] = fsig[1: nfreq].conjugate()[::-1]
 
@@ -379,23 +456,14 @@ def angle(a, b):
 
 
 def add_noise(a, freqs, sr, scale, taplen=0.05):
-    out = a.copy()
-
     nsig, npts = a.shape
-    fwin = freq_window(freqs, npts, sr)
-    nfreq = len(fwin)
-
-    for i in range(nsig):
-        fb = np.zeros(npts, dtype=np.complex64)
+    fwin = spectral.freq_window(freqs, npts, sr)
 
-        phases = np.random.rand(nfreq) * 2 * np.pi
-        phases = np.cos(phases) + 1j * np.sin(phases)
+    out = a + spectral.band_limited_noise((nsig, npts), fwin) * scale
+    taplen_npts = int(taplen * npts)
 
-        fb[: nfreq] = phases * fwin
-        fb[-nfreq + 1:] = fb[1:nfreq].conjugate()[::-1]
-        # a[i] = np.real(ifft(fb))
-        out[i] += np.real(ifft(fb)) * scale
-    taper2d(out, int(taplen * npts))
+    if taplen_npts > 0:
+        out = taper2d(out, taplen_npts)
 
     return out
 
@@ -461,12 +529,8 @@ def band_noise(band, sr, samples):
 
 
 def envelope(data):
-    slen = len(data)
-    FFT = fft(data, slen)
-    FFT[1: slen // 2] *= 2
-    FFT[slen // 2:] = 0
 
-    return np.abs(ifft(FFT))
+    return spectral.envelope(data)
 
 
 def read_csv(filename, site_code='', **kwargs):
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------
+# Filename: archive.py
+#  Purpose: indexed access to archives of continuous waveform data
+#   Author: uquake development team
+#    Email: devs@uquake.org
+#
+# Copyright (C) 2016 uquake development team
+# --------------------------------------------------------------------
+"""
+indexed access to archives of continuous waveform data
+
+A directory tree of MiniSEED files (flat or SDS layout) is indexed record by
+record into a SQLite database. Window queries only read and decode the
+records overlapping the requested time window instead of the whole files.
+
+:copyright:
+    uquake development team (devs@uquake.org)
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+import os
+import sqlite3
+from glob import glob
+from io import BytesIO
+
+from obspy import UTCDateTime
+from obspy.io.mseed.util import get_record_information
+
+from loguru import logger
+from ...core import Stream, read
+
+# the fixed section of the data header and the blockettes are always
+# contained in the first 512 bytes of a record
+HEADER_BYTES = 512
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files(
+id INTEGER PRIMARY KEY,
+path text UNIQUE NOT NULL,
+size integer NOT NULL,
+mtime real NOT NULL
+);
+CREATE TABLE IF NOT EXISTS records(
+file_id integer NOT NULL,
+network text NOT NULL,
+station text NOT NULL,
+location text NOT NULL,
+channel text NOT NULL,
+starttime real NOT NULL,
+endtime real NOT NULL,
+offset integer NOT NULL,
+length integer NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_time ON records(starttime, endtime);
+CREATE INDEX IF NOT EXISTS records_file ON records(file_id, offset);
+CREATE INDEX IF NOT EXISTS records_duration ON records(endtime - starttime);
+"""
+
+
+class WaveformArchive(object):
+    """
+    Index of a continuous waveform archive stored as MiniSEED files.
+
+    :param index_file: path to the SQLite index, created if it does not exist
+    :type index_file: str
+
+    example:
+
+    >>> archive = WaveformArchive('archive.sqlite')
+    >>> archive.index('/data/continuous')
+    >>> st = archive.query(starttime, starttime + 2, station='11*')
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.connection = sqlite3.connect(index_file)
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def index(self, root, pattern='**/*', reindex=False):
+        """
+        index all the MiniSEED files found under root. Files already in the
+        index are skipped unless their size or modification time changed.
+        The indexed files under root that no longer exist are removed from
+        the index.
+        :param root: root directory of the archive
+        :type root: str
+        :param pattern: glob pattern relative to root, recursive by default
+        (e.g., '*/*/*/*.D/*' for an SDS archive)
+        :type pattern: str
+        :param reindex: if True, all files are indexed again
+        :type reindex: bool
+        :return: number of files added to the index
+        :rtype: int
+        """
+
+        n_indexed = 0
+
+        for path in sorted(glob(os.path.join(root, pattern), recursive=True)):
+            if not os.path.isfile(path):
+                continue
+
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+
+            row = self.connection.execute(
+                'SELECT id, size, mtime FROM files WHERE path=?',
+                (path,)).fetchone()
+
+            if row is not None:
+                if (not reindex) and (row[1] == stat.st_size) and \
+                        (row[2] == stat.st_mtime):
+                    continue
+                self._remove_file(row[0])
+
+            try:
+                records = _scan_records(path)
+            except Exception as e:
+                logger.debug(f'skipping {path}: {e}')
+                continue
+
+            with self.connection:
+                cursor = self.connection.execute(
+                    'INSERT INTO files(path, size, mtime) VALUES (?, ?, ?)',
+                    (path, stat.st_size, stat.st_mtime))
+                file_id = cursor.lastrowid
+                self.connection.executemany(
+                    'INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(file_id,) + record for record in records])
+
+            n_indexed += 1
+
+        # files deleted from the archive since they were indexed
+        root = os.path.join(os.path.abspath(root), '')
+        missing = [file_id for file_id, path in self.connection.execute(
+                   'SELECT id, path FROM files')
+                   if path.startswith(root) and not os.path.isfile(path)]
+
+        for file_id in missing:
+            self._remove_file(file_id)
+
+        logger.info(f'{n_indexed} files added to the index, {len(missing)} '
+                    f'missing files removed')
+
+        return n_indexed
+
+    def _remove_file(self, file_id):
+        with self.connection:
+            self.connection.execute('DELETE FROM records WHERE file_id=?',
+                                    (file_id,))
+            self.connection.execute('DELETE FROM files WHERE id=?',
+                                    (file_id,))
+
+    def _select_records(self, windows, network='*', station='*',
+                        location='*', channel='*'):
+        """
+        return the (window index, file_id, offset, length) of the records
+        overlapping every time window, in one query. The windows are sorted
+        and joined with the records on a bounded range of start times, which
+        uses both bounds of the time index. Codes accept the "*" and "?"
+        wildcards.
+        :param windows: list of (starttime, endtime) tuples of UTCDateTime
+        """
+
+        # the records overlapping a window start at most one record duration
+        # before it
+        max_duration = self.connection.execute(
+            'SELECT MAX(endtime - starttime) FROM records').fetchone()[0]
+
+        if max_duration is None:
+            return []
+
+        order = sorted(range(len(windows)),
+                       key=lambda k: windows[k][0].timestamp)
+
+        query = 'SELECT w.id, r.file_id, r.offset, r.length ' \
+                'FROM temp.windows AS w CROSS JOIN records AS r ' \
+                'WHERE r.starttime BETWEEN w.starttime - ? AND w.endtime ' \
+                'AND r.endtime >= w.starttime ' \
+                'AND r.network GLOB ? AND r.station GLOB ? ' \
+                'AND r.location GLOB ? AND r.channel GLOB ?'
+
+        with self.connection:
+            self.connection.execute(
+                'CREATE TEMP TABLE IF NOT EXISTS windows(id integer, '
+                'starttime real, endtime real)')
+            self.connection.execute('DELETE FROM temp.windows')
+            self.connection.executemany(
+                'INSERT INTO temp.windows VALUES (?, ?, ?)',
+                [(k, windows[k][0].timestamp, windows[k][1].timestamp)
+                 for k in order])
+
+            return self.connection.execute(
+                query, (max_duration, network, station, location,
+                        channel)).fetchall()
+
+    def query(self, starttime, endtime, network='*', station='*',
+              location='*', channel='*', fill_value=None):
+        """
+        return the waveforms in a time window reading only the records
+        overlapping the window
+        :param starttime: start of the window
+        :type starttime: ~obspy.UTCDateTime
+        :param endtime: end of the window
+        :type endtime: ~obspy.UTCDateTime
+        :param network: network code, wildcards are accepted
+        :param station: station code, wildcards are accepted
+        :param location: location code, wildcards are accepted
+        :param channel: channel code, wildcards are accepted
+        :param fill_value: value used to fill the gaps when merging the
+        records, gaps are masked if None
+        :rtype: ~uquake.core.stream.Stream
+        """
+
+        return self.query_many([(starttime, endtime)], network=network,
+                               station=station, location=location,
+                               channel=channel, fill_value=fill_value)[0]
+
+    def query_many(self, windows, network='*', station='*', location='*',
+                   channel='*', fill_value=None):
+        """
+        extract many time windows in one sorted pass over the archive. Each
+        file is opened once and each record is decoded once regardless of
+        the number of windows it contributes to.
+        :param windows: list of (starttime, endtime) tuples
+        :type windows: list
+        :param fill_value: value used to fill the gaps when merging the
+        records, gaps are masked if None
+        :return: list of Stream, one per window in the order of the input
+        :rtype: list of ~uquake.core.stream.Stream
+        """
+
+        windows = [(UTCDateTime(t0), UTCDateTime(t1)) for t0, t1 in windows]
+
+        # mapping file_id -> {(offset, length): [window indices]}
+        file_records = {}
+
+        for k, file_id, offset, length in self._select_records(
+                windows, network=network, station=station,
+                location=location, channel=channel):
+            records = file_records.setdefault(file_id, {})
+            records.setdefault((offset, length), []).append(k)
+
+        paths = dict(self.connection.execute('SELECT id, path FROM files'))
+        traces = [[] for _ in windows]
+
+        for file_id in sorted(file_records, key=lambda fid: paths[fid]):
+            with open(paths[file_id], 'rb') as fle:
+                for offset, length, members in _contiguous_blocks(
+                        file_records[file_id]):
+                    fle.seek(offset)
+                    st = read(BytesIO(fle.read(length)), format='MSEED')
+
+                    for k in members:
+                        t0, t1 = windows[k]
+                        traces[k] += st.slice(t0, t1).traces
+
+        return [Stream(traces=trs).merge_segments(fill_value=fill_value)
+                for trs in traces]
+
+    def query_catalog(self, catalog, pre=0.5, post=1.5, **kwargs):
+        """
+        extract the waveforms around the origin time of every event of a
+        catalog, see query_many for the additional keyword arguments
+        :param catalog: events for which to extract the waveforms
+        :type catalog: ~uquake.core.event.Catalog
+        :param pre: time in second before the origin time
+        :type pre: float
+        :param post: time in second after the origin time
+        :type post: float
+        :return: list of Stream, one per event
+        :rtype: list of ~uquake.core.stream.Stream
+        """
+
+        windows = []
+
+        for event in catalog:
+            origin = event.preferred_origin() or event.origins[-1]
+            windows.append((origin.time - pre, origin.time + post))
+
+        return self.query_many(windows, **kwargs)
+
+
+def _scan_records(path):
+    """
+    return the header information of every record in a MiniSEED file as
+    tuples (network, station, location, channel, starttime, endtime, offset,
+    length)
+    """
+
+    with open(path, 'rb') as fle:
+        buf = fle.read()
+
+    records = []
+    offset = 0
+
+    while offset < len(buf):
+        info = get_record_information(
+            BytesIO(buf[offset:offset + HEADER_BYTES]))
+        length = info['record_length']
+        records.append((info['network'], info['station'], info['location'],
+                        info['channel'], info['starttime'].timestamp,
+                        info['endtime'].timestamp, offset, length))
+        offset += length
+
+    return records
+
+
+def _contiguous_blocks(records):
+    """
+    group records adjacent in a file into blocks that can be read and decoded
+    in one operation
+    :param records: {(offset, length): [window indices]}
+    :return: list of (offset, length, set of window indices)
+    """
+
+    blocks = []
+
+    for (offset, length) in sorted(records):
+        members = records[(offset, length)]
+
+        if blocks and (blocks[-1][0] + blocks[-1][1] == offset):
+            blocks[-1][1] += length
+            blocks[-1][2].update(members)
+        else:
+            blocks.append([offset, length, set(members)])
+
+    return blocks
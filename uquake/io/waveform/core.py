@@ -19,12 +19,15 @@ plugin for reading and writing various waveform format expending
     (http://www.gnu.org/copyleft/lesser.html)
 """
 
+import os
+import weakref
 from datetime import datetime, timedelta
 from glob import glob
 from struct import unpack
 
 # from io import BytesIO
 import numpy as np
+import pandas as pd
 from dateutil.parser import parse
 from obspy import UTCDateTime
 from obspy.core.trace import Stats
@@ -82,50 +85,78 @@ def mseed_date_from_header(block4096):
     return UTCDateTime(dt)
 
 
-def read_IMS_ASCII(path, net='', **kwargs):
+def read_IMS_ASCII(path, net='', dtype=np.float64, **kwargs):
     """
     read a IMS_ASCII seismogram from a single station
-    :param path: path to file
+    :param path: path to file, a list of paths or a glob pattern. When more
+    than one file is provided the traces are returned in a single stream.
+    :param net: network code
+    :param dtype: data type of the samples (e.g., np.float32)
     :return: microquake.core.Stream
     """
 
-    data = np.loadtxt(path, delimiter=',', skiprows=1)
-    stats = Stats()
+    if isinstance(path, (list, tuple)):
+        paths = path
+    elif isinstance(path, str) and any(c in path for c in '*?['):
+        paths = sorted(glob(path))
+    else:
+        return Stream(traces=_read_IMS_ASCII_file(path, net=net, dtype=dtype))
+
+    traces = []
+
+    for fname in paths:
+        traces += _read_IMS_ASCII_file(fname, net=net, dtype=dtype)
+
+    return Stream(traces=traces)
+
+
+def _read_IMS_ASCII_file(path, net='', dtype=np.float64):
+    """
+    read a single IMS_ASCII file and return a list of traces. The file is
+    read once, the header line is parsed first and the numerical block is
+    parsed in bulk by the pandas C parser.
+    """
 
     with open(path) as fid:
         field = fid.readline().split(',')
+        data = pd.read_csv(fid, header=None, dtype=dtype,
+                           engine='c').values
 
-    stats.sampling_rate = float(field[1])
+    sampling_rate = float(field[1])
     timetmp = datetime.fromtimestamp(float(field[5])) \
         + timedelta(seconds=float(field[6]) / 1e6)  # trigger time in second
 
     trgtime_UTC = UTCDateTime(timetmp)
-    stats.starttime = trgtime_UTC - float(field[10]) / stats.sampling_rate
-    stats.npts = len(data)
-
-    stats.station = field[8]
-    stats.network = net
+    starttime = trgtime_UTC - float(field[10]) / sampling_rate
 
     traces = []
     component = np.array(['X', 'Y', 'Z'])
-    std = np.std(data, axis=0)
-    mstd = np.max(std)
 
     for k, dt in enumerate(data.T):
+        stats = Stats()
+        stats.sampling_rate = sampling_rate
+        stats.starttime = starttime
+        stats.npts = len(dt)
+        stats.station = field[8]
+        stats.network = net
         stats.channel = '%s' % (component[k])
-        traces.append(Trace(data=np.array(dt), header=stats))
+        # copy so each trace owns a contiguous array
+        traces.append(Trace(data=np.ascontiguousarray(dt), header=stats))
 
-    return Stream(traces=traces)
+    return traces
 
 
 @uncompress
-def read_ESG_SEGY(fname, site=None, **kwargs):
+def read_ESG_SEGY(fname, site=None, headonly=False, **kwargs):
     """
     read data produced by ESG and turn them into a valid stream with network,
     station and component information properly filled
     :param fname: the filename
     :param site: a site object containing sensor information
     :type site: ~microquake.core.station.Site
+    :param headonly: if True only the headers are read, the traces contain
+    no data
+    :type headonly: bool
     :return: ~microquake.core.stream.Stream
     """
 
@@ -136,45 +167,51 @@ def read_ESG_SEGY(fname, site=None, **kwargs):
                        'the site, network, station or component information '
                        'will not be appended')
 
-        return read(fname, format='SEGY',  unpack_trace_headers=True)
+        return read(fname, format='SEGY', unpack_trace_headers=True,
+                    headonly=headonly)
 
-    st = read(fname, format='SEGY',  unpack_trace_headers=True)
-
-    stations = site.stations()
-    traces = []
+    # the trace headers are unpacked on access, only the coordinates and
+    # the lag times are needed
+    st = read(fname, format='SEGY', unpack_trace_headers=False,
+              headonly=headonly)
 
-    for k, tr in enumerate(st):
-        x = tr.stats.segy.trace_header.group_coordinate_x
-        y = tr.stats.segy.trace_header.group_coordinate_y
+    if len(st) == 0:
+        return Stream()
 
-        hdist_min = 1e10
-        station = None
-        network = None
+    tree, stations, networks = _site_index(site)
 
-        for net in site:
-            for sta in net:
-                hdist = np.linalg.norm([sta.x - x, sta.y - y])
+    xy = np.array([[tr.stats.segy.trace_header.group_coordinate_x,
+                    tr.stats.segy.trace_header.group_coordinate_y]
+                   for tr in st])
+    _, nearest = tree.query(xy)
 
-                if hdist < hdist_min:
-                    hdist_min = hdist
-                    station = sta
-                    network = net
+    # grouping the traces by station following the site station order,
+    # a stable sort keeps the order of the traces within a station
+    order = np.argsort(nearest, kind='stable')
+    station_indices, first, counts = np.unique(nearest[order],
+                                               return_index=True,
+                                               return_counts=True)
+    groups = {i_sta: order[i0:i0 + n]
+              for i_sta, i0, n in zip(station_indices, first, counts)}
 
-        tr.stats.station = station.code
-        tr.stats.network = network.code
-        traces.append(Trace(trace=tr))
-
-    st2 = Stream(traces=traces)
     traces = []
 
-    for station in site.stations():
+    for i_sta, station in enumerate(stations):
         if np.all(station.loc == [1000, 1000, 1000]):
             continue
-        sttmp = st2.copy().select(station=station.code)
 
-        for k, tr in enumerate(sttmp):
+        if i_sta not in groups:
+            continue
+
+        trace_indices = groups[i_sta]
+
+        for k, i_tr in enumerate(trace_indices):
+            tr = st[i_tr]
+            tr.stats.station = station.code
+            tr.stats.network = networks[i_sta].code
+
             if k == 0:
-                if len(sttmp) == 3:
+                if len(trace_indices) == 3:
                     tr.stats.channel = 'X'
                 else:
                     tr.stats.channel = 'Z'
@@ -189,115 +226,187 @@ def read_ESG_SEGY(fname, site=None, **kwargs):
             usecs = msec_starttime / 1000. + usec_starttime / 1.0e6
             tr.stats.starttime = tr.stats.starttime + usecs
 
-            traces.append(Trace(trace=tr))
+            traces.append(tr)
 
     return Stream(traces=traces)
 
-@uncompress
-def read_TEXCEL_CSV(filename, **kwargs):
+
+def scan_ESG_SEGY(fnames, site=None):
+    """
+    catalogue ESG SEGY files reading only the headers
+    :param fnames: a path, a list of paths or a glob pattern
+    :param site: a site object containing sensor information
+    :type site: ~microquake.core.station.Site
+    :return: one row per trace with the file name, the trace id, the start
+    and end times, the sampling rate and the number of samples
+    :rtype: pandas.DataFrame
     """
-    Reads a texcel csv file and returns a microquake Stream object.
 
-    .. warning::
-        This function should NOT be called directly, it registers via the
-        microquake :func:`~microquake.core.stream.read` function, call this
-        instead.
-    :param filename: the path to the file
-    :param kwargs:
-    :return: ~microquake.core.stream.Stream
+    if isinstance(fnames, str):
+        fnames = sorted(glob(fnames))
+
+    rows = []
+
+    for fname in fnames:
+        try:
+            st = read_ESG_SEGY(fname, site=site, headonly=True)
+        except Exception as e:
+            logger.error(f'could not read {fname}: {e}')
+            continue
+
+        for tr in st:
+            rows.append({'filename': fname,
+                         'network': tr.stats.network,
+                         'station': tr.stats.station,
+                         'channel': tr.stats.channel,
+                         'starttime': tr.stats.starttime.datetime,
+                         'endtime': tr.stats.endtime.datetime,
+                         'sampling_rate': tr.stats.sampling_rate,
+                         'npts': tr.stats.npts})
+
+    return pd.DataFrame(rows, columns=['filename', 'network', 'station',
+                                       'channel', 'starttime', 'endtime',
+                                       'sampling_rate', 'npts'])
+
+
+# KD-tree of the horizontal sensor coordinates built once per site, keyed by
+# id(site) (sites are not hashable). The entries hold a weak reference to the
+# site and are removed when the site is garbage collected.
+_site_indices = {}
+
+
+def _site_index(site):
+    """
+    return a KD-tree of the horizontal coordinates of the stations of a site
+    along with the station and network objects in the same order. The tree
+    is rebuilt when the stations or their coordinates change.
     """
 
-    with open(filename) as fle:
-        x = []
-        y = []
-        z = []
+    stations = []
+    networks = []
 
-        for k, line in enumerate(fle):
-            if k == 0:
-                if 'MICROPHONE' in line:
-                    offset = 9
-                else:
-                    offset = 8
-            # header
+    for net in site:
+        for sta in net:
+            stations.append(sta)
+            networks.append(net)
 
-            if k < 2:
-                continue
+    signature = tuple((net.code, sta.code, sta.x, sta.y)
+                      for net, sta in zip(networks, stations))
 
-            val = line.strip().split(',')
+    entry = _site_indices.get(id(site))
 
-            # relative time
+    if entry is not None:
+        site_ref, cached_signature, index = entry
 
-            if k == 3:
-                rt0 = timedelta(seconds=float(val[0]))
+        # the id of a collected site can be reused by another object
+        if site_ref() is site and cached_signature == signature:
+            return index
 
-            elif k == 6:
-                station = str(eval(val[offset]))
+    from scipy.spatial import cKDTree
 
-            elif k == 7:
-                date = val[offset]
+    tree = cKDTree([[sta.x, sta.y] for sta in stations])
+    index = (tree, stations, networks)
 
-            elif k == 8:
-                date_time = date + " " + val[offset]
-                datetime = parse(date_time)
-                starttime = datetime + rt0
+    if entry is None or entry[0]() is not site:
+        weakref.finalize(site, _site_indices.pop, id(site), None)
 
-            elif k == 9:
-                site = val[offset]
+    _site_indices[id(site)] = (weakref.ref(site), signature, index)
 
-            elif k == 10:
-                location = val[offset]
+    return index
 
-            elif k == 17:
 
-                sensitivity_x = float(val[offset])
-                sensitivity_y = float(val[offset + 1])
-                sensitivity_z = float(val[offset + 2])
+# number of lines carrying header fields in a TEXCEL csv file, the samples
+# start on the third line
+TEXCEL_HEADER_LINES = 22
 
-            elif k == 18:
-                range_x = float(val[offset])
-                range_y = float(val[offset + 1])
-                range_z = float(val[offset + 2])
 
-            elif k == 19:
-                trigger_x = float(val[offset])
-                trigger_y = float(val[offset + 1])
-                trigger_z = float(val[offset + 2])
+def read_TEXCEL_CSV(filename, **kwargs):
+    """
+    Reads a texcel csv file and returns a microquake Stream object.
 
-            elif k == 20:
-                si_x = float(val[offset])
-                si_y = float(val[offset + 1])
-                si_z = float(val[offset + 2])
+    .. warning::
+        This function should NOT be called directly, it registers via the
+        microquake :func:`~microquake.core.stream.read` function, call this
+        instead.
+    :param filename: the path to the file, a list of paths or a directory.
+    The traces of all the csv files of a directory are returned in a single
+    stream.
+    :param kwargs:
+    :return: ~microquake.core.stream.Stream
+    """
 
-            elif k == 21:
-                sr_x = float(val[offset])
-                sr_y = float(val[offset + 1])
-                sr_z = float(val[offset + 2])
+    if isinstance(filename, (list, tuple)):
+        filenames = filename
+    elif isinstance(filename, str) and os.path.isdir(filename):
+        filenames = sorted(glob(os.path.join(filename, '*.csv')))
+    else:
+        return Stream(traces=_read_TEXCEL_CSV_file(filename))
 
-            x.append(float(val[1]))
-            y.append(float(val[2]))
-            z.append(float(val[3]))
+    traces = []
 
-        x = np.array(x)
-        y = np.array(y)
-        z = np.array(z)
+    for fname in filenames:
+        traces += _read_TEXCEL_CSV_file(fname)
+
+    return Stream(traces=traces)
 
+
+@uncompress
+def _read_TEXCEL_CSV_file(filename, **kwargs):
+    """
+    read a single texcel csv file and return a list of traces. The header
+    block is parsed once and the sample columns are parsed in bulk by the
+    pandas C parser.
+    """
+
+    with open(filename) as fle:
+        header = [fle.readline() for _ in range(TEXCEL_HEADER_LINES)]
+
+        try:
+            body = pd.read_csv(fle, header=None, usecols=[1, 2, 3],
+                               dtype=np.float64, engine='c').values
+        except pd.errors.EmptyDataError:
+            body = np.empty((0, 3))
+
+    if 'MICROPHONE' in header[0]:
+        offset = 9
+    else:
+        offset = 8
+
+    fields = [line.strip().split(',') for line in header]
+
+    # relative time
+    rt0 = timedelta(seconds=float(fields[3][0]))
+    station = fields[6][offset].strip().strip('"\'')
+    date_time = fields[7][offset] + " " + fields[8][offset]
+    starttime = parse(date_time) + rt0
+    site = fields[9][offset]
+    location = fields[10][offset]
+    # sample interval in ms for each axis
+    sample_intervals = [float(val) for val in
+                        fields[20][offset:offset + 3]]
+
+    # the lines of the header block also carry samples
+    header_samples = [[float(val) for val in field[1:4]]
+                      for field in fields[2:]]
+
+    n_header = len(header_samples)
+    data = np.empty((n_header + len(body), 3))
+    data[:n_header] = header_samples
+    data[n_header:] = body
+    data /= 1000.0
+
+    traces = []
+
+    for k, channel in enumerate(['radial', 'transverse', 'vertical']):
         stats = Stats()
         stats.network = site
-        stats.delta = si_x / 1000.0
-        stats.npts = len(x)
+        stats.delta = sample_intervals[k] / 1000.0
+        stats.npts = len(data)
         stats.location = location
         stats.station = station
         stats.starttime = UTCDateTime(starttime)
+        stats.channel = channel
+        traces.append(Trace(data=np.ascontiguousarray(data[:, k]),
+                            header=stats))
 
-        stats.channel = 'radial'
-        tr_x = Trace(data=x / 1000.0, header=stats)
-
-        stats.delta = si_y / 1000.0
-        stats.channel = 'transverse'
-        tr_y = Trace(data=y / 1000.0, header=stats)
-
-        stats.delta = si_z / 1000.0
-        stats.channel = 'vertical'
-        tr_z = Trace(data=z / 1000.0, header=stats)
-
-    return Stream(traces=[tr_x, tr_y, tr_z])
+    return traces
@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------
+# Filename: double_difference.py
+#  Purpose: double-difference relative relocation
+#   Author: uquake development team
+#    Email: devs@uquake.org
+#
+# Copyright (C) 2016 uquake development team
+# --------------------------------------------------------------------
+"""
+double-difference relative relocation
+
+Catalog differential times are formed between neighbouring events (the
+nearest neighbours within a maximum distance) for the phases recorded at
+the same sensor. Cross-correlation differential times of the same pairs
+are built from the event waveforms (see cc_differential_times). The
+linearized system is solved with LSQR on sparse matrices, one cluster of
+connected events at a time. The travel times are computed in a homogeneous
+medium.
+
+example:
+
+>>> dd = DoubleDifferenceRelocator(sensor_locations, vp=5000, vs=3500)
+>>> cc_dtimes = dd.cc_differential_times(catalog, streams)
+>>> dd.relocate(catalog, cc_dtimes=cc_dtimes)
+
+:copyright:
+    uquake development team (devs@uquake.org)
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+import numpy as np
+import pandas as pd
+from obspy.core.event import ResourceIdentifier
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import lsqr
+from scipy.spatial import cKDTree
+
+from loguru import logger
+from ..core.event import Origin
+
+# unknowns per event: x, y, z and origin time
+N_PARAMETERS = 4
+
+CC_COLUMNS = ['i', 'j', 'sensor', 'phase', 'dt', 'cc']
+
+
+def sensor_locations_from_inventory(inventory):
+    """
+    return a dictionary mapping the station and sensor codes to the sensor
+    locations
+    :param inventory: inventory
+    :type inventory: ~uquake.core.inventory.Inventory
+    :rtype: dict
+    """
+
+    locations = {}
+
+    for network in inventory:
+        for station in network:
+            locations[station.code] = np.array(station.loc)
+
+            for sensor in station.sensors:
+                locations[sensor.code] = np.array(sensor.loc)
+
+    return locations
+
+
+class DoubleDifferenceRelocator(object):
+    """
+    double-difference relocation of the events of a catalog
+    :param sensor_locations: dictionary mapping station or sensor codes
+    (station + location codes) to (x, y, z)
+    :type sensor_locations: dict
+    :param vp: P-wave velocity in m/s
+    :param vs: S-wave velocity in m/s
+    :param max_distance: maximum distance between paired events in m
+    :param max_neighbours: maximum number of neighbours of an event
+    :param min_links: minimum number of differential times for a pair of
+    events to be used
+    :param n_iterations: number of iterations
+    :param damping: LSQR damping, the columns of the system are scaled to a
+    unit norm
+    :param catalog_weight: weight of the catalog differential times
+    :param cc_weight: weight of the cross-correlation differential times,
+    multiplied by the squared correlation coefficient
+    :param residual_cutoff: differential times with residuals larger than
+    residual_cutoff times the median absolute residual are discarded after
+    the first iteration
+    :param fix_centroid: if True, the centroid of every cluster is not moved
+    """
+
+    def __init__(self, sensor_locations, vp=5000., vs=3500.,
+                 max_distance=200., max_neighbours=10, min_links=8,
+                 n_iterations=5, damping=0.01, catalog_weight=1.,
+                 cc_weight=1., residual_cutoff=6., fix_centroid=True):
+
+        self.sensor_locations = sensor_locations
+        self.velocities = {'P': vp, 'S': vs}
+        self.max_distance = max_distance
+        self.max_neighbours = max_neighbours
+        self.min_links = min_links
+        self.n_iterations = n_iterations
+        self.damping = damping
+        self.catalog_weight = catalog_weight
+        self.cc_weight = cc_weight
+        self.residual_cutoff = residual_cutoff
+        self.fix_centroid = fix_centroid
+
+    def _sensor_code(self, pick):
+        if pick.waveform_id is None:
+            return None
+
+        for code in (pick.sensor, pick.get_sta()):
+            if code in self.sensor_locations:
+                return code
+
+        return None
+
+    def observations(self, catalog):
+        """
+        return the event locations, origin times and the travel times of
+        the picks relative to the origin times
+        :param catalog: catalog
+        :return: locations (n, 3), origin times (n,) and a DataFrame of
+        travel times with columns event, sensor, phase and tt
+        """
+
+        locations = np.zeros((len(catalog), 3))
+        times = np.zeros(len(catalog))
+        rows = []
+
+        for k, event in enumerate(catalog):
+            origin = event.preferred_origin() or event.origins[-1]
+            locations[k] = origin.loc
+            times[k] = origin.time.timestamp
+
+            for pick in event.picks:
+                phase = (pick.phase_hint or '').upper()
+                sensor = self._sensor_code(pick)
+
+                if (phase not in self.velocities) or (sensor is None):
+                    continue
+
+                rows.append((k, sensor, phase, pick.time - origin.time))
+
+        tts = pd.DataFrame(rows, columns=['event', 'sensor', 'phase', 'tt'])
+        tts = tts.drop_duplicates(['event', 'sensor', 'phase'], keep='last')
+
+        return locations, times, tts
+
+    def pairs(self, locations):
+        """
+        return the pairs (i < j) of neighbouring events
+        :param locations: event locations, array of shape (n, 3)
+        :rtype: numpy.ndarray of shape (npairs, 2)
+        """
+
+        n_events = len(locations)
+
+        if n_events < 2:
+            return np.zeros((0, 2), dtype=int)
+
+        k = min(self.max_neighbours + 1, n_events)
+        _, neighbours = cKDTree(locations).query(
+            locations, k=k, distance_upper_bound=self.max_distance)
+
+        ii = np.repeat(np.arange(n_events), k)
+        jj = neighbours.ravel()
+        valid = (jj < n_events) & (jj != ii)
+
+        pairs = np.sort(np.vstack((ii[valid], jj[valid])).T, axis=1)
+
+        return np.unique(pairs, axis=0)
+
+    def differential_times(self, catalog, cc_dtimes=None):
+        """
+        return the catalog and cross-correlation differential times
+        :param catalog: catalog
+        :param cc_dtimes: cross-correlation differential times, DataFrame with
+        the columns i, j (indices of the events in the catalog), sensor,
+        phase, dt (differential travel time tt_i - tt_j) and cc (correlation
+        coefficient)
+        :type cc_dtimes: pandas.DataFrame
+        :return: locations, origin times and DataFrame of differential times
+        with the columns i, j, sensor, phase, dt and weight
+        """
+
+        locations, times, tts = self.observations(catalog)
+        pairs = pd.DataFrame(self.pairs(locations), columns=['i', 'j'])
+
+        dtimes = pairs.merge(
+            tts.rename(columns={'event': 'i', 'tt': 'tt_i'}), on='i').merge(
+            tts.rename(columns={'event': 'j', 'tt': 'tt_j'}),
+            on=['j', 'sensor', 'phase'])
+
+        # pairs with too few links are not constrained
+        links = dtimes.groupby(['i', 'j'])['tt_i'].transform('size')
+        dtimes = dtimes[links >= self.min_links]
+
+        dtimes = pd.DataFrame({'i': dtimes['i'], 'j': dtimes['j'],
+                               'sensor': dtimes['sensor'],
+                               'phase': dtimes['phase'],
+                               'dt': dtimes['tt_i'] - dtimes['tt_j'],
+                               'weight': self.catalog_weight})
+
+        if cc_dtimes is not None and len(cc_dtimes):
+            cc_dtimes = cc_dtimes[CC_COLUMNS]
+            cc_dtimes = cc_dtimes[
+                cc_dtimes['sensor'].isin(self.sensor_locations.keys()) &
+                cc_dtimes['phase'].isin(self.velocities.keys())]
+            dtimes = pd.concat([dtimes, pd.DataFrame({
+                'i': cc_dtimes['i'], 'j': cc_dtimes['j'],
+                'sensor': cc_dtimes['sensor'], 'phase': cc_dtimes['phase'],
+                'dt': cc_dtimes['dt'],
+                'weight': self.cc_weight * cc_dtimes['cc'] ** 2})],
+                ignore_index=True)
+
+        return locations, times, dtimes.reset_index(drop=True)
+
+    def cc_differential_times(self, catalog, streams, window_length=0.05,
+                              pre_pick=0.01, max_shift=0.01, min_cc=0.7,
+                              workers=1):
+        """
+        return the cross-correlation differential times of the neighbouring
+        events (see pairs). Windows starting pre_pick before the picks are cut
+        from every channel of the sensors, the windows of the pairs are
+        cross-correlated with uquake.waveform.correlation.correlate_pairs and
+        the channel with the highest coefficient is kept for every pair,
+        sensor and phase.
+        :param catalog: catalog
+        :param streams: waveforms of every event, a list aligned with the
+        catalog or a function returning the stream of an event
+        :param window_length: length of the windows in second
+        :param pre_pick: time before the picks in second
+        :param max_shift: maximum lag in second, all the lags if None
+        :param min_cc: minimum correlation coefficient
+        :param workers: number of processes used by correlate_pairs
+        :return: DataFrame with the columns i, j, sensor, phase, dt and cc
+        (see differential_times)
+        :rtype: pandas.DataFrame
+        """
+
+        from ..waveform.correlation import correlate_pairs
+
+        locations, times, tts = self.observations(catalog)
+        pairs = self.pairs(locations)
+
+        if callable(streams):
+            streams = map(streams, catalog)
+
+        picks = tts.groupby('event')
+        # event indices, travel times and windows by sensor, phase, channel
+        # and sampling rate
+        windows = {}
+
+        for k, (event, stream) in enumerate(zip(catalog, streams)):
+            if (stream is None) or (k not in picks.groups):
+                continue
+
+            traces = {}
+
+            for tr in stream:
+                for code in {tr.stats.station,
+                             tr.stats.station + tr.stats.location}:
+                    traces.setdefault(code, []).append(tr)
+
+            for sensor, phase, tt in picks.get_group(k)[
+                    ['sensor', 'phase', 'tt']].itertuples(index=False):
+                start_time = times[k] + tt - pre_pick
+
+                for tr in traces.get(sensor, []):
+                    sr = tr.stats.sampling_rate
+                    start = int(round(
+                        (start_time - tr.stats.starttime.timestamp) * sr))
+                    npts = int(round(window_length * sr))
+
+                    if (start < 0) or (start + npts > len(tr.data)):
+                        continue
+
+                    window = windows.setdefault(
+                        (sensor, phase, tr.stats.channel, sr), ([], [], []))
+                    window[0].append(k)
+                    window[1].append(tt)
+                    window[2].append(tr.data[start:start + npts])
+
+        cc_dtimes = []
+
+        for (sensor, phase, _, sr), (events, tt, data) in windows.items():
+            index = np.full(len(catalog), -1)
+            index[events] = np.arange(len(events))
+            local = index[pairs]
+            local = local[(local >= 0).all(axis=1)]
+
+            if not len(local):
+                continue
+
+            max_lag = None if max_shift is None else int(round(max_shift * sr))
+            _, lags, cc = correlate_pairs(data, pairs=local, max_lag=max_lag,
+                                          workers=workers)
+
+            # a positive lag means the window of j is delayed relative to
+            # the window of i
+            tt = np.array(tt)
+            events = np.array(events)
+            cc_dtimes.append(pd.DataFrame({
+                'i': events[local[:, 0]], 'j': events[local[:, 1]],
+                'sensor': sensor, 'phase': phase,
+                'dt': tt[local[:, 0]] - tt[local[:, 1]] - lags / sr,
+                'cc': cc}))
+
+        if not cc_dtimes:
+            return pd.DataFrame(columns=CC_COLUMNS)
+
+        cc_dtimes = pd.concat(cc_dtimes, ignore_index=True)
+        cc_dtimes = cc_dtimes[cc_dtimes['cc'] >= min_cc]
+        cc_dtimes = cc_dtimes.sort_values('cc').drop_duplicates(
+            ['i', 'j', 'sensor', 'phase'], keep='last')
+
+        logger.info(f'{len(cc_dtimes)} cross-correlation differential times')
+
+        return cc_dtimes[CC_COLUMNS].sort_values(['i', 'j']).reset_index(
+            drop=True)
+
+    def relocate(self, catalog, cc_dtimes=None):
+        """
+        relocate the events of a catalog. A new origin is appended to every
+        relocated event and set as the preferred origin.
+        :param catalog: catalog, the events must have a preferred origin (or
+        at least one origin) with x, y, z and picks
+        :param cc_dtimes: cross-correlation differential times, see
+        differential_times and cc_differential_times
+        :return: the catalog and a DataFrame with the shifts of the events
+        :rtype: tuple(~uquake.core.event.Catalog, pandas.DataFrame)
+        """
+
+        locations, times, dtimes = self.differential_times(
+            catalog, cc_dtimes=cc_dtimes)
+
+        shifts = np.zeros((len(catalog), N_PARAMETERS))
+        relocated = np.zeros(len(catalog), dtype=bool)
+
+        if len(dtimes):
+            sensors = np.array([self.sensor_locations[sensor]
+                                for sensor in dtimes['sensor']],
+                               dtype=float)
+            velocities = dtimes['phase'].map(self.velocities).values
+            ii = dtimes['i'].values
+            jj = dtimes['j'].values
+
+            n_events = len(catalog)
+            graph = coo_matrix((np.ones(len(ii)), (ii, jj)),
+                               shape=(n_events, n_events))
+            n_clusters, labels = connected_components(graph, directed=False)
+
+            for cluster in range(n_clusters):
+                events = np.nonzero(labels == cluster)[0]
+
+                if len(events) < 2:
+                    continue
+
+                rows = np.nonzero(labels[ii] == cluster)[0]
+                shifts[events] = self._solve_cluster(
+                    events, locations, ii[rows], jj[rows],
+                    dtimes['dt'].values[rows],
+                    dtimes['weight'].values[rows], sensors[rows],
+                    velocities[rows])
+                relocated[events] = True
+
+            logger.info(f'{relocated.sum()} events relocated in '
+                        f'{n_clusters} clusters')
+
+        for k, event in enumerate(catalog):
+            if not relocated[k]:
+                continue
+
+            origin = event.preferred_origin() or event.origins[-1]
+            x, y, z = locations[k] + shifts[k, :3]
+            new_origin = Origin(x=x, y=y, z=z,
+                                time=origin.time + shifts[k, 3],
+                                evaluation_mode=origin.evaluation_mode,
+                                method_id=ResourceIdentifier(
+                                    'double_difference'))
+            event.origins.append(new_origin)
+            event.preferred_origin_id = new_origin.resource_id.id
+
+        shift_table = pd.DataFrame(shifts, columns=['dx', 'dy', 'dz', 'dt'])
+        shift_table['relocated'] = relocated
+
+        return catalog, shift_table
+
+    def _solve_cluster(self, events, locations, ii, jj, dt, weights,
+                       sensors, velocities):
+        """
+        solve the double-difference system of a cluster with LSQR
+        :return: shifts (dx, dy, dz, dt) of the events of the cluster
+        """
+
+        n_events = len(events)
+        index = np.full(len(locations), -1)
+        index[events] = np.arange(n_events)
+        ci = index[ii]
+        cj = index[jj]
+
+        locs = locations[events].copy()
+        tau = np.zeros(n_events)
+        weights = weights.copy()
+
+        rows = np.repeat(np.arange(len(dt)), 2 * N_PARAMETERS)
+        columns = np.hstack([
+            (N_PARAMETERS * ci)[:, np.newaxis] + np.arange(N_PARAMETERS),
+            (N_PARAMETERS * cj)[:, np.newaxis] + np.arange(N_PARAMETERS)]
+        ).ravel()
+
+        for iteration in range(self.n_iterations):
+            delta_i = locs[ci] - sensors
+            delta_j = locs[cj] - sensors
+            dist_i = np.maximum(np.linalg.norm(delta_i, axis=1), 1e-6)
+            dist_j = np.maximum(np.linalg.norm(delta_j, axis=1), 1e-6)
+
+            predicted = (dist_i - dist_j) / velocities + tau[ci] - tau[cj]
+            residuals = dt - predicted
+
+            if iteration > 0 and self.residual_cutoff is not None:
+                selected = np.abs(residuals[weights > 0])
+
+                # the median of an empty selection is nan
+                if len(selected):
+                    mad = np.median(selected)
+                    weights[np.abs(residuals) >
+                            self.residual_cutoff * mad] = 0
+
+            sqrt_w = np.sqrt(weights)
+            derivatives_i = delta_i / (dist_i * velocities)[:, np.newaxis]
+            derivatives_j = delta_j / (dist_j * velocities)[:, np.newaxis]
+            values = np.hstack([derivatives_i,
+                                np.ones((len(dt), 1)),
+                                -derivatives_j,
+                                -np.ones((len(dt), 1))]) * sqrt_w[:, np.newaxis]
+
+            matrix = coo_matrix((values.ravel(), (rows, columns)),
+                                shape=(len(dt), N_PARAMETERS * n_events))
+            matrix = matrix.tocsc()
+
+            # column scaling, the derivatives have different units
+            norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0))
+                            ).ravel()
+            norms[norms == 0] = 1
+            matrix = matrix.multiply(1 / norms[np.newaxis, :]).tocsr()
+
+            solution = lsqr(matrix, residuals * sqrt_w,
+                            damp=self.damping)[0] / norms
+            solution = solution.reshape(n_events, N_PARAMETERS)
+
+            if self.fix_centroid:
+                solution -= np.mean(solution, axis=0)
+
+            locs += solution[:, :3]
+            tau += solution[:, 3]
+
+            rms = np.sqrt(np.average(residuals ** 2, weights=weights)) \
+                if weights.sum() > 0 else 0
+            logger.debug(f'cluster of {n_events} events, iteration '
+                         f'{iteration}: rms residual {rms:0.5f} s')
+
+        shifts = np.zeros((n_events, N_PARAMETERS))
+        shifts[:, :3] = locs - locations[events]
+        shifts[:, 3] = tau
+
+        return shifts
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------
+# Filename: grid_search.py
+#  Purpose: grid-search hypocenter location using travel-time grids
+#   Author: uquake development team
+#    Email: devs@uquake.org
+#
+# Copyright (C) 2016 uquake development team
+# --------------------------------------------------------------------
+"""
+grid-search hypocenter location using travel-time grids
+
+The least-squares misfit of the picks, with the origin time eliminated
+analytically, is evaluated for all the nodes of a chunk of the grid at once.
+The grid is first searched with a coarse step, the best candidates are then
+searched at full resolution. The uncertainty is estimated from the scatter
+of the nodes weighted by their likelihood and is not smaller than the grid
+spacing.
+
+example:
+
+>>> locator = GridSearchLocator(travel_time_grids)
+>>> origin = locator.locate(event.picks)
+
+:copyright:
+    uquake development team (devs@uquake.org)
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from obspy.core.event import (ConfidenceEllipsoid, OriginUncertainty,
+                              ResourceIdentifier)
+
+from loguru import logger
+from ..core.event import Arrival, Origin
+
+# default memory budget of a chunk of misfit evaluation in bytes
+MEMORY_BUDGET = 2 ** 27
+
+
+def pick_sensor_code(pick, codes):
+    """
+    return the sensor code (station + location codes) or the station code of
+    a pick if it is in codes, None otherwise
+    """
+
+    if pick.waveform_id is None:
+        return None
+
+    # the codes of a WaveformStreamID default to None
+    station = pick.waveform_id.station_code or ''
+
+    for code in (station + (pick.waveform_id.location_code or ''), station):
+        if code in codes:
+            return code
+
+    return None
+
+
+class GridSearchLocator(object):
+    """
+    grid-search locator
+    :param travel_time_grids: dictionary mapping (sensor code, phase) to the
+    travel-time Grid of the sensor and phase. All the grids must have the
+    same shape, spacing and origin.
+    :type travel_time_grids: dict
+    :param coarse_step: step in nodes of the coarse search
+    :param n_candidates: number of coarse nodes searched at full resolution
+    :param pick_uncertainty: pick uncertainty in second, used for the
+    likelihood of the nodes
+    :param memory_budget: approximate memory used by a chunk of nodes in
+    bytes
+    :param workers: number of threads evaluating the chunks
+    """
+
+    def __init__(self, travel_time_grids, coarse_step=4, n_candidates=3,
+                 pick_uncertainty=1e-3, memory_budget=MEMORY_BUDGET,
+                 workers=1):
+
+        grids = list(travel_time_grids.values())
+
+        if not grids:
+            raise ValueError('no travel-time grids')
+
+        for grid in grids[1:]:
+            if (grid.shape != grids[0].shape) or \
+                    np.any(grid.spacing != grids[0].spacing) or \
+                    np.any(grid.origin != grids[0].origin):
+                raise ValueError('the travel-time grids must have the same '
+                                 'shape, spacing and origin')
+
+        self.shape = grids[0].shape
+        self.spacing = np.array(grids[0].spacing, dtype=float)
+        self.origin = np.array(grids[0].origin, dtype=float)
+        # flat views of the grids, nothing is copied for contiguous grids
+        self.travel_times = dict(
+            (key, np.ravel(grid.data)) for key, grid in
+            travel_time_grids.items())
+        self.sensors = set(sensor for sensor, _ in travel_time_grids)
+
+        self.coarse_step = coarse_step
+        self.n_candidates = n_candidates
+        self.pick_uncertainty = pick_uncertainty
+        self.memory_budget = memory_budget
+        self.workers = workers
+
+    def _observations(self, picks):
+        used = []
+
+        for pick in picks:
+            phase = (pick.phase_hint or '').upper()
+            sensor = pick_sensor_code(pick, self.sensors)
+
+            if (sensor, phase) in self.travel_times:
+                used.append((pick, (sensor, phase)))
+
+        return used
+
+    def misfit(self, nodes, keys, times, weights):
+        """
+        return the misfit and origin time (relative to the times) of nodes
+        :param nodes: flat indices of the nodes
+        :param keys: (sensor, phase) of every observation
+        :param times: observed times
+        :param weights: weight of every observation
+        :rtype: tuple(numpy.ndarray, numpy.ndarray)
+        """
+
+        chunk_size = max(1, int(self.memory_budget // (3 * 8 * len(keys))))
+        chunks = [nodes[k:k + chunk_size]
+                  for k in range(0, len(nodes), chunk_size)]
+
+        def evaluate(chunk):
+            delays = np.empty((len(keys), len(chunk)))
+
+            for k, key in enumerate(keys):
+                np.take(self.travel_times[key], chunk, out=delays[k])
+
+            # delays = observed time - travel time, its weighted mean is the
+            # origin time minimizing the misfit
+            np.subtract(times[:, np.newaxis], delays, out=delays)
+            weighted = weights @ delays
+            origin_times = weighted / weights.sum()
+            misfits = weights @ (delays ** 2) - weighted * origin_times
+
+            return misfits, origin_times
+
+        if self.workers == 1 or len(chunks) == 1:
+            results = [evaluate(chunk) for chunk in chunks]
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = list(executor.map(evaluate, chunks))
+
+        if not results:
+            return np.zeros(0), np.zeros(0)
+
+        return np.concatenate([result[0] for result in results]), \
+            np.concatenate([result[1] for result in results])
+
+    def _coarse_nodes(self):
+        axes = [np.arange(0, n, self.coarse_step) for n in self.shape]
+        indices = np.meshgrid(*axes, indexing='ij')
+
+        return np.ravel_multi_index([index.ravel() for index in indices],
+                                    self.shape)
+
+    def _refined_nodes(self, centres):
+        nodes = []
+
+        for centre in np.array(np.unravel_index(centres, self.shape)).T:
+            axes = [np.arange(max(c - self.coarse_step, 0),
+                              min(c + self.coarse_step + 1, n))
+                    for c, n in zip(centre, self.shape)]
+            indices = np.meshgrid(*axes, indexing='ij')
+            nodes.append(np.ravel_multi_index(
+                [index.ravel() for index in indices], self.shape))
+
+        return np.unique(np.concatenate(nodes))
+
+    def node_coordinates(self, nodes):
+        return np.array(np.unravel_index(nodes, self.shape)).T * \
+            self.spacing + self.origin
+
+    def locate(self, picks, weights=None):
+        """
+        locate an event
+        :param picks: picks of the event
+        :type picks: list of ~uquake.core.event.Pick
+        :param weights: weight of every pick, all the picks have the same
+        weight if None
+        :return: origin with the arrivals, their residuals and the
+        uncertainty, None if less than 4 picks have a travel-time grid
+        :rtype: ~uquake.core.event.Origin
+        """
+
+        if weights is None:
+            weights = np.ones(len(picks))
+
+        pick_weights = dict((id(pick), weight) for pick, weight
+                            in zip(picks, weights))
+        observations = self._observations(picks)
+
+        if len(observations) < 4:
+            logger.warning(f'{len(observations)} picks with travel-time '
+                           f'grids, at least 4 are required')
+            return None
+
+        reference = min(pick.time for pick, _ in observations)
+        keys = [key for _, key in observations]
+        times = np.array([pick.time - reference for pick, _ in observations])
+        weights = np.array([pick_weights[id(pick)]
+                            for pick, _ in observations], dtype=float)
+
+        coarse = self._coarse_nodes()
+        misfits, _ = self.misfit(coarse, keys, times, weights)
+        candidates = coarse[np.argsort(misfits)[:self.n_candidates]]
+
+        nodes = self._refined_nodes(candidates)
+        misfits, origin_times = self.misfit(nodes, keys, times, weights)
+        best = np.argmin(misfits)
+
+        location = self.node_coordinates(nodes[best:best + 1])[0]
+        origin_time = reference + origin_times[best]
+
+        # likelihood of the refined nodes, the misfit is a weighted sum of
+        # squared residuals
+        likelihood = np.exp(-(misfits - misfits[best]) /
+                            (2 * self.pick_uncertainty ** 2 *
+                             weights.mean()))
+        likelihood /= likelihood.sum()
+
+        origin = Origin(x=location[0], y=location[1], z=location[2],
+                        time=origin_time, evaluation_mode='automatic',
+                        method_id=ResourceIdentifier('grid_search'))
+        self._set_uncertainty(origin, self.node_coordinates(nodes),
+                              likelihood, self.spacing)
+
+        for (pick, key), t in zip(observations, times):
+            travel_time = self.travel_times[key][nodes[best]]
+            residual = t - origin_times[best] - travel_time
+            origin.arrivals.append(Arrival(pick_id=pick.resource_id,
+                                           phase=key[1],
+                                           time_residual=residual))
+
+        return origin
+
+    @staticmethod
+    def _set_uncertainty(origin, coordinates, likelihood, spacing,
+                         max_scatter=1000):
+        """
+        set the errors, the confidence ellipsoid (one standard deviation)
+        and the scatter (nodes with the largest likelihood with columns x,
+        y, z and likelihood) of an origin. The location is resolved to a
+        node, the errors and the axes of the ellipsoid are not smaller than
+        the grid spacing.
+        """
+
+        mean = likelihood @ coordinates
+        deviations = coordinates - mean
+        covariance = (deviations * likelihood[:, np.newaxis]).T @ deviations
+
+        origin.x_error, origin.y_error, origin.z_error = \
+            np.maximum(np.sqrt(np.diag(covariance)), spacing)
+
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        lengths = np.maximum(np.sqrt(np.maximum(eigenvalues, 0)),
+                             np.min(spacing))
+        major = eigenvectors[:, 2]
+
+        ellipsoid = ConfidenceEllipsoid(
+            semi_major_axis_length=lengths[2],
+            semi_intermediate_axis_length=lengths[1],
+            semi_minor_axis_length=lengths[0],
+            major_axis_azimuth=np.degrees(np.arctan2(major[0], major[1]))
+            % 360,
+            major_axis_plunge=np.degrees(np.arcsin(min(abs(major[2]), 1))),
+            major_axis_rotation=0)
+        origin.origin_uncertainty = OriginUncertainty(
+            confidence_ellipsoid=ellipsoid,
+            preferred_description='confidence ellipsoid')
+
+        order = np.argsort(likelihood)[::-1][:max_scatter]
+        origin.scatter = np.hstack((coordinates[order],
+                                    likelihood[order][:, np.newaxis]))
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------
+# Filename: interloc.py
+#  Purpose: waveform coalescence (back-projection) location
+#   Author: uquake development team
+#    Email: devs@uquake.org
+#
+# Copyright (C) 2016 uquake development team
+# --------------------------------------------------------------------
+"""
+waveform coalescence (back-projection) location
+
+Characteristic functions (envelopes, STA/LTA) of the waveforms are shifted
+by the travel times from every grid node to the sensors and stacked. Only
+the maximum of the stack over time and its time are kept for every node.
+The nodes are processed in blocks whose size is bounded by a memory budget,
+optionally on a pool of processes.
+
+example:
+
+>>> interloc = InterlocLocator(travel_time_grids)
+>>> origin = interloc.locate_stream(stream.composite())
+
+:copyright:
+    uquake development team (devs@uquake.org)
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from time import time as timer
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from obspy.core.event import ResourceIdentifier
+
+from loguru import logger
+from ..core.event import Origin
+from ..core.util import spectral
+
+# default memory budget of a block of stacks in bytes
+MEMORY_BUDGET = 2 ** 27
+
+# characteristic functions and shifts shared with the worker processes, set
+# by _init_worker
+_shared = {}
+
+
+def sta_lta(data, sta, lta):
+    """
+    STA/LTA of the energy of the rows of data computed with running sums. The
+    STA and LTA windows end at the current sample.
+    :param data: array of shape (nchan, npts)
+    :param sta: short term window length in samples
+    :param lta: long term window length in samples
+    :rtype: numpy.ndarray
+    """
+
+    data = np.atleast_2d(data)
+    cumsum = np.zeros((data.shape[0], data.shape[1] + 1))
+    np.cumsum(data.astype(np.float64) ** 2, axis=1, out=cumsum[:, 1:])
+
+    index = np.arange(1, data.shape[1] + 1)
+    sta_mean = (cumsum[:, index] - cumsum[:, np.maximum(index - sta, 0)]) \
+        / np.minimum(index, sta)
+    lta_mean = (cumsum[:, index] - cumsum[:, np.maximum(index - lta, 0)]) \
+        / np.minimum(index, lta)
+
+    out = np.zeros_like(sta_mean)
+    valid = lta_mean > 0
+    out[valid] = sta_mean[valid] / lta_mean[valid]
+    # the LTA is not reliable before a full window
+    out[:, :lta] = 0
+
+    return out
+
+
+def characteristic_function(data, method='envelope', sta=None, lta=None):
+    """
+    characteristic functions of the rows of data normalized to a maximum of 1
+    :param data: array of shape (nchan, npts)
+    :param method: 'envelope' or 'sta_lta'
+    :param sta: STA window in samples (sta_lta only)
+    :param lta: LTA window in samples (sta_lta only)
+    :rtype: numpy.ndarray
+    """
+
+    if method == 'envelope':
+        cf = spectral.envelope(data)
+    elif method == 'sta_lta':
+        cf = sta_lta(data, sta, lta)
+    else:
+        raise ValueError(f'unknown characteristic function {method}')
+
+    norm = np.max(np.abs(cf), axis=-1, keepdims=True)
+    norm[norm == 0] = 1
+
+    return cf / norm
+
+
+class InterlocLocator(object):
+    """
+    coalescence locator
+    :param travel_time_grids: dictionary mapping (sensor code, phase) to the
+    travel-time Grid of the sensor and phase. All the grids must have the
+    same shape, spacing and origin.
+    :type travel_time_grids: dict
+    :param phase: phase used to shift the characteristic functions
+    :param memory_budget: approximate memory used by a block of nodes in
+    bytes
+    :param workers: number of processes
+    """
+
+    def __init__(self, travel_time_grids, phase='P',
+                 memory_budget=MEMORY_BUDGET, workers=1):
+
+        grids = dict((sensor, grid) for (sensor, grid_phase), grid
+                     in travel_time_grids.items() if grid_phase == phase)
+
+        if not grids:
+            raise ValueError(f'no travel-time grid for phase {phase}')
+
+        reference = list(grids.values())[0]
+        self.shape = reference.shape
+        self.spacing = np.array(reference.spacing, dtype=float)
+        self.origin = np.array(reference.origin, dtype=float)
+        self.grids = grids
+        self.phase = phase
+        self.memory_budget = memory_budget
+        self.workers = workers
+
+    def _sensor(self, trace_id):
+        network, station, location, channel = trace_id.split('.')
+
+        for code in (station + location, station):
+            if code in self.grids:
+                return code
+
+        return None
+
+    def node_coordinates(self, nodes):
+        return np.array(np.unravel_index(nodes, self.shape)).T * \
+            self.spacing + self.origin
+
+    def stack_maximum(self, cf, sampling_rate, ids):
+        """
+        maximum over time of the stack of the characteristic functions for
+        every node
+        :param cf: characteristic functions, array of shape (nchan, npts)
+        :param sampling_rate: sampling rate of cf
+        :param ids: trace id of every row of cf
+        :return: maximum of the stack and its sample index (origin time)
+        for every node, arrays of the shape of the grids
+        :rtype: tuple(numpy.ndarray, numpy.ndarray)
+        """
+
+        rows = []
+        shifts = []
+
+        for k, trace_id in enumerate(ids):
+            sensor = self._sensor(trace_id)
+
+            if sensor is None:
+                continue
+
+            rows.append(k)
+            shifts.append(np.rint(np.ravel(self.grids[sensor].data) *
+                                  sampling_rate).astype(np.int32))
+
+        if not rows:
+            raise ValueError('no travel-time grid for the traces')
+
+        shifts = np.array(shifts)
+        npts = cf.shape[1]
+        max_shift = int(shifts.max())
+
+        # zero padded so every node is stacked over the same npts samples
+        padded = np.zeros((len(rows), npts + max_shift), dtype=np.float32)
+        padded[:, :npts] = cf[rows]
+
+        n_nodes = shifts.shape[1]
+        block_size = max(1, int(self.memory_budget // (2 * 4 * npts)))
+        blocks = [(k, min(k + block_size, n_nodes))
+                  for k in range(0, n_nodes, block_size)]
+
+        shared = {'cf': padded, 'shifts': shifts, 'npts': npts}
+
+        if self.workers == 1 or len(blocks) == 1:
+            _shared.update(shared)
+
+            try:
+                results = [_stack_block(block) for block in blocks]
+            finally:
+                _shared.clear()
+        else:
+            # the characteristic functions and shifts are sent once to every
+            # process
+            with ProcessPoolExecutor(max_workers=self.workers,
+                                     initializer=_init_worker,
+                                     initargs=(shared,)) as executor:
+                results = list(executor.map(_stack_block, blocks))
+
+        vmax = np.concatenate([result[0] for result in results])
+        imax = np.concatenate([result[1] for result in results])
+
+        return vmax.reshape(self.shape) / len(rows), imax.reshape(self.shape)
+
+    def locate(self, cf, sampling_rate, starttime, ids):
+        """
+        locate an event from characteristic functions
+        :param cf: characteristic functions, array of shape (nchan, npts)
+        :param sampling_rate: sampling rate of cf
+        :param starttime: time of the first sample of cf
+        :param ids: trace id of every row of cf
+        :return: location of the best node, origin time and stack value
+        :rtype: tuple(numpy.ndarray, ~obspy.UTCDateTime, float)
+        """
+
+        vmax, imax = self.stack_maximum(cf, sampling_rate, ids)
+        best = np.argmax(vmax)
+
+        location = self.node_coordinates(np.array([best]))[0]
+        origin_time = starttime + imax.ravel()[best] / sampling_rate
+
+        return location, origin_time, float(vmax.ravel()[best])
+
+    def locate_stream(self, stream, method='envelope', sta=None, lta=None,
+                      sampling_rate=None):
+        """
+        locate an event from a stream (e.g., composite traces)
+        :param stream: waveforms
+        :type stream: ~uquake.core.stream.Stream
+        :param method: characteristic function, see characteristic_function
+        :param sta: STA window in second (sta_lta only)
+        :param lta: LTA window in second (sta_lta only)
+        :param sampling_rate: sampling rate at which the stack is computed,
+        the highest sampling rate of the stream if None
+        :return: origin with interloc_vmax set to the stack value and
+        interloc_time to the processing time in second
+        :rtype: ~uquake.core.event.Origin
+        """
+
+        start = timer()
+        data, sr, t0, ids = stream.as_array(sampling_rate=sampling_rate,
+                                            return_ids=True)
+
+        if method == 'sta_lta':
+            cf = characteristic_function(data, method=method,
+                                         sta=int(sta * sr),
+                                         lta=int(lta * sr))
+        else:
+            cf = characteristic_function(data, method=method)
+
+        location, origin_time, vmax = self.locate(cf, sr, t0, ids)
+        elapsed = timer() - start
+
+        logger.info(f'interloc: vmax {vmax:0.3f} at {location} '
+                    f'in {elapsed:0.2f} s')
+
+        return Origin(x=location[0], y=location[1], z=location[2],
+                      time=origin_time, evaluation_mode='automatic',
+                      method_id=ResourceIdentifier('interloc'),
+                      interloc_vmax=vmax, interloc_time=elapsed)
+
+
+def _init_worker(shared):
+    _shared.update(shared)
+
+
+def _stack_block(block):
+    start, end = block
+    npts = _shared['npts']
+    cf = _shared['cf']
+    shifts = _shared['shifts'][:, start:end]
+
+    stack = np.zeros((end - start, npts), dtype=np.float32)
+
+    for row, shift in zip(cf, shifts):
+        # view of all the windows of npts samples (as_strided, numpy 1.18
+        # has no sliding_window_view), the windows starting at the travel
+        # time of every node are gathered
+        windows = as_strided(row, shape=(len(row) - npts + 1, npts),
+                             strides=(row.strides[0], row.strides[0]),
+                             writeable=False)
+        stack += windows[shift]
+
+    imax = np.argmax(stack, axis=1)
+
+    return stack[np.arange(len(stack)), imax], imax
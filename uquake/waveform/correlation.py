@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------
+# Filename: correlation.py
+#  Purpose: batched cross-correlation of waveforms
+#   Author: uquake development team
+#    Email: devs@uquake.org
+#
+# Copyright (C) 2016 uquake development team
+# --------------------------------------------------------------------
+"""
+batched cross-correlation of waveforms
+
+The spectrum of every waveform is computed once. The cross-spectra of the
+pairs are formed and transformed back in blocks whose size is bounded by a
+memory budget, optionally on a pool of processes.
+
+example:
+
+>>> lags, cc = correlate_matrix(masters, slaves, max_lag=50)
+>>> pairs, lags, cc = correlate_pairs(waveforms, max_lag=50)
+
+:copyright:
+    uquake development team (devs@uquake.org)
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ..core.util import spectral
+
+# default memory budget of a block of cross-correlations in bytes
+MEMORY_BUDGET = 2 ** 28
+
+# spectra shared with the worker processes, set by _init_worker
+_spectra = {}
+
+
+def as_matrix(waveforms, demean=True):
+    """
+    return the waveforms as the rows of a 2-D array, shorter waveforms are
+    zero padded at the end
+    :param waveforms: 2-D array, list of 1-D arrays or Stream
+    :param demean: if True, the mean of every waveform is removed
+    :rtype: numpy.ndarray
+    """
+
+    if hasattr(waveforms, 'traces'):
+        waveforms = [tr.data for tr in waveforms]
+
+    if isinstance(waveforms, np.ndarray) and waveforms.ndim == 2:
+        matrix = waveforms.astype(np.float64)
+    else:
+        npts = np.max([len(wf) for wf in waveforms])
+        matrix = np.zeros((len(waveforms), npts))
+
+        for i, wf in enumerate(waveforms):
+            matrix[i, :len(wf)] = wf
+
+    if demean:
+        matrix -= np.mean(matrix, axis=1)[:, np.newaxis]
+
+    return matrix
+
+
+def correlate_matrix(masters, slaves, max_lag=None, interpolate=True,
+                     memory_budget=MEMORY_BUDGET, workers=1):
+    """
+    cross-correlate every master with every slave waveform
+    :param masters: N master waveforms, see as_matrix
+    :param slaves: M slave waveforms, see as_matrix
+    :param max_lag: maximum lag in samples, all the lags if None
+    :param interpolate: if True, the lag and coefficient of the peak are
+    refined by parabolic interpolation
+    :param memory_budget: approximate memory used by a block of
+    cross-correlations in bytes
+    :param workers: number of processes
+    :return: lags (in samples) and correlation coefficients of the peaks,
+    arrays of shape (N, M). A positive lag means the slave is delayed
+    relative to the master (see tools.amax_cc).
+    :rtype: tuple(numpy.ndarray, numpy.ndarray)
+    """
+
+    masters = as_matrix(masters)
+    slaves = as_matrix(slaves)
+
+    ii, jj = np.meshgrid(np.arange(len(masters)), np.arange(len(slaves)),
+                         indexing='ij')
+
+    lags, cc = _correlate(masters, slaves, ii.ravel(), jj.ravel(),
+                          max_lag=max_lag, interpolate=interpolate,
+                          memory_budget=memory_budget, workers=workers)
+
+    return lags.reshape(ii.shape), cc.reshape(ii.shape)
+
+
+def correlate_pairs(waveforms, pairs=None, max_lag=None, interpolate=True,
+                    memory_budget=MEMORY_BUDGET, workers=1):
+    """
+    cross-correlate pairs of waveforms from the same set (e.g., the events
+    of a cluster)
+    :param waveforms: waveforms, see as_matrix
+    :param pairs: array of shape (P, 2) with the indices of the waveforms of
+    every pair, all the pairs (i, j) with i < j if None
+    :param max_lag: maximum lag in samples, all the lags if None
+    :param interpolate: if True, the lag and coefficient of the peak are
+    refined by parabolic interpolation
+    :param memory_budget: approximate memory used by a block of
+    cross-correlations in bytes
+    :param workers: number of processes
+    :return: pairs, lags (in samples) and correlation coefficients of the
+    peaks, arrays of length P
+    :rtype: tuple(numpy.ndarray, numpy.ndarray, numpy.ndarray)
+    """
+
+    waveforms = as_matrix(waveforms)
+
+    if pairs is None:
+        pairs = np.array(np.triu_indices(len(waveforms), k=1)).T
+    pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+
+    lags, cc = _correlate(waveforms, waveforms, pairs[:, 0], pairs[:, 1],
+                          max_lag=max_lag, interpolate=interpolate,
+                          memory_budget=memory_budget, workers=workers)
+
+    return pairs, lags, cc
+
+
+def _correlate(masters, slaves, ii, jj, max_lag=None, interpolate=True,
+               memory_budget=MEMORY_BUDGET, workers=1):
+
+    npts = max(masters.shape[1], slaves.shape[1])
+    # linear correlation, no wrap around for lags up to npts
+    nfft = spectral.fast_length(2 * npts)
+
+    if max_lag is None:
+        max_lag = npts - 1
+    max_lag = int(min(max_lag, npts - 1))
+
+    spectra = {'masters': spectral.rfft(masters, n=nfft),
+               'slaves': spectral.rfft(slaves, n=nfft),
+               'norm_masters': np.sqrt(np.sum(masters ** 2, axis=1)),
+               'norm_slaves': np.sqrt(np.sum(slaves ** 2, axis=1)),
+               'nfft': nfft,
+               'max_lag': max_lag,
+               'interpolate': interpolate}
+
+    # gathered spectra, cross-spectra and correlations of one pair
+    nfreq = nfft // 2 + 1
+    pair_bytes = 3 * 16 * nfreq + 2 * 8 * nfft
+    block_size = max(1, int(memory_budget // pair_bytes))
+
+    blocks = [(ii[k:k + block_size], jj[k:k + block_size])
+              for k in range(0, len(ii), block_size)]
+
+    if workers == 1 or len(blocks) == 1:
+        _spectra.update(spectra)
+
+        try:
+            results = [_correlate_block(block) for block in blocks]
+        finally:
+            _spectra.clear()
+    else:
+        # the spectra are sent once to every process
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(spectra,)) as executor:
+            results = list(executor.map(_correlate_block, blocks))
+
+    if not results:
+        return np.zeros(0), np.zeros(0)
+
+    lags = np.concatenate([result[0] for result in results])
+    cc = np.concatenate([result[1] for result in results])
+
+    return lags, cc
+
+
+def _init_worker(spectra):
+    _spectra.update(spectra)
+
+
+def _correlate_block(block):
+    ii, jj = block
+    nfft = _spectra['nfft']
+    max_lag = _spectra['max_lag']
+
+    cross = np.conj(_spectra['masters'][ii])
+    cross *= _spectra['slaves'][jj]
+    cc = spectral.irfft(cross, nfft)
+
+    # lags -max_lag to max_lag
+    cc = np.concatenate((cc[:, nfft - max_lag:], cc[:, :max_lag + 1]),
+                        axis=1)
+
+    norm = _spectra['norm_masters'][ii] * _spectra['norm_slaves'][jj]
+    norm[norm == 0] = 1
+    cc /= norm[:, np.newaxis]
+
+    imax = np.argmax(cc, axis=1)
+    rows = np.arange(len(cc))
+    peak = cc[rows, imax]
+    lags = (imax - max_lag).astype(float)
+
+    if _spectra['interpolate']:
+        delta, peak = parabolic_peak(cc, imax)
+        lags += delta
+
+    return lags, peak
+
+
+def parabolic_peak(cc, imax):
+    """
+    refine the position and value of the maximum of every row with a
+    parabola through the maximum and its two neighbours
+    :param cc: 2-D array
+    :param imax: index of the maximum of every row
+    :return: offsets in samples relative to imax and interpolated maxima
+    :rtype: tuple(numpy.ndarray, numpy.ndarray)
+    """
+
+    rows = np.arange(len(cc))
+    # the maxima on the edges are not interpolated
+    inner = (imax > 0) & (imax < cc.shape[1] - 1)
+    i0 = np.clip(imax, 1, cc.shape[1] - 2)
+
+    y0 = cc[rows, i0 - 1]
+    y1 = cc[rows, i0]
+    y2 = cc[rows, i0 + 1]
+
+    curvature = y0 - 2 * y1 + y2
+    valid = inner & (curvature < 0)
+    curvature[~valid] = -1
+
+    delta = np.where(valid, 0.5 * (y0 - y2) / curvature, 0)
+    peak = np.where(valid, y1 - 0.25 * (y0 - y2) * delta,
+                    cc[rows, imax])
+
+    return delta, peak
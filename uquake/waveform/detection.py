@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------
+# Filename: detection.py
+#  Purpose: template matching (matched filter) detection
+#   Author: uquake development team
+#    Email: devs@uquake.org
+#
+# Copyright (C) 2016 uquake development team
+# --------------------------------------------------------------------
+"""
+template matching (matched filter) detection over continuous data
+
+Multi-channel templates are correlated with continuous data using FFTs. The
+correlation is normalized with running sums of the data, the channel
+correlations are stacked across the network and the detections are the
+peaks of the stack above a multiple of its median absolute deviation.
+
+example:
+
+>>> templates = [Template(st_event, name=str(k))
+...              for k, st_event in enumerate(event_streams)]
+>>> with MatchedFilterDetector(templates, threshold=9, workers=4) as det:
+...     for chunk in chunks:
+...         detections = det.process(chunk)
+
+:copyright:
+    uquake development team (devs@uquake.org)
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.signal import find_peaks
+
+from ..core.stream import Stream
+from ..core.util import spectral
+
+# templates known by the worker processes, set by _init_worker
+_templates = []
+
+
+class Template(object):
+    """
+    multi-channel template
+    :param stream: template waveforms, every trace must have the same sampling
+    rate. The relative start times of the traces (moveout) are kept.
+    :type stream: ~uquake.core.stream.Stream
+    :param name: name of the template reported with the detections
+    """
+
+    def __init__(self, stream, name=None):
+        sampling_rates = set(tr.stats.sampling_rate for tr in stream)
+
+        if len(sampling_rates) != 1:
+            raise ValueError('the traces of a template must have the same '
+                             'sampling rate')
+
+        self.name = name
+        self.sampling_rate = sampling_rates.pop()
+        self.starttime = min(tr.stats.starttime for tr in stream)
+
+        npts = min(tr.stats.npts for tr in stream)
+        self.ids = []
+        self.offsets = []
+        waveforms = []
+
+        for tr in stream:
+            waveform = np.asarray(tr.data[:npts], dtype=np.float64)
+            waveform = waveform - np.mean(waveform)
+            norm = np.sqrt(np.sum(waveform ** 2))
+
+            if norm == 0:
+                continue
+
+            self.ids.append(tr.id)
+            self.offsets.append(int(round((tr.stats.starttime -
+                                           self.starttime) *
+                                          self.sampling_rate)))
+            waveforms.append(waveform / norm)
+
+        self.offsets = np.array(self.offsets, dtype=int)
+        self.waveforms = np.array(waveforms)
+        self.npts = npts
+        # number of samples spanned by the template including the moveout
+        self.span = int(self.offsets.max() + npts) if len(waveforms) else 0
+        self._spectra = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_spectra'] = {}
+
+        return state
+
+    def spectra(self, nfft):
+        # the spectra of the time-reversed waveforms are cached by length
+        if nfft not in self._spectra:
+            self._spectra[nfft] = spectral.rfft(self.waveforms[:, ::-1],
+                                                n=nfft)
+
+        return self._spectra[nfft]
+
+
+def normalized_correlation(data, template, spectra=None):
+    """
+    normalized cross-correlation of a template with the rows of data. The
+    normalization uses running sums, the energy of each data window is not
+    recomputed.
+    :param data: array of shape (C, n)
+    :param template: zero mean and unit norm templates, array of shape (C, m)
+    :param spectra: rfft of the reversed templates with length nfft, computed
+    if None
+    :return: correlation coefficients, array of shape (C, n - m + 1)
+    :rtype: numpy.ndarray
+    """
+
+    n = data.shape[-1]
+    m = template.shape[-1]
+    nfft = spectral.fast_length(n + m - 1)
+
+    if spectra is None:
+        spectra = spectral.rfft(template[:, ::-1], n=nfft)
+
+    cc = spectral.irfft(spectral.rfft(data, n=nfft) * spectra,
+                        nfft)[:, m - 1:n]
+
+    cumsum = np.zeros((data.shape[0], n + 1))
+    np.cumsum(data, axis=1, out=cumsum[:, 1:])
+    cumsum2 = np.zeros((data.shape[0], n + 1))
+    np.cumsum(data ** 2, axis=1, out=cumsum2[:, 1:])
+
+    sums = cumsum[:, m:] - cumsum[:, :-m]
+    energy = cumsum2[:, m:] - cumsum2[:, :-m] - sums ** 2 / m
+
+    # flat windows (e.g., gaps filled with zeros) do not correlate
+    valid = energy > 1e-10 * np.max(energy, axis=1, initial=0)[:, np.newaxis]
+    cc[~valid] = 0
+    cc[valid] /= np.sqrt(energy[valid])
+
+    return cc
+
+
+def network_stack(cc, offsets, npos):
+    """
+    stack the correlations of the channels of a template aligned on the
+    template start
+    :param cc: correlations, array of shape (C, n)
+    :param offsets: offset in samples of every channel in the template
+    :param npos: number of positions of the stack
+    :rtype: numpy.ndarray
+    """
+
+    stack = np.zeros(npos)
+
+    for c, offset in enumerate(offsets):
+        stack += cc[c, offset:offset + npos]
+
+    return stack / len(offsets)
+
+
+def mad(a):
+    return np.median(np.abs(a - np.median(a)))
+
+
+def scan(template, data, ids, threshold, min_channels=1):
+    """
+    scan data with a template
+    :param template: template
+    :type template: Template
+    :param data: continuous data, array of shape (nchan, n)
+    :param ids: trace id of every row of data
+    :param threshold: detection threshold in multiple of the MAD of the stack
+    above its median
+    :param min_channels: minimum number of template channels in the data
+    :return: positions, stack values and MAD-normalized values (median
+    removed) of the detections and the number of channels used, None if the
+    template cannot be scanned
+    """
+
+    rows = dict((tr_id, k) for k, tr_id in enumerate(ids))
+    channels = [c for c, tr_id in enumerate(template.ids) if tr_id in rows]
+    npos = data.shape[1] - template.span + 1
+
+    if len(channels) < max(min_channels, 1) or npos <= 0:
+        return None
+
+    x = data[[rows[template.ids[c]] for c in channels]]
+    nfft = spectral.fast_length(x.shape[1] + template.npts - 1)
+    spectra = template.spectra(nfft)[channels]
+
+    cc = normalized_correlation(x, template.waveforms[channels],
+                                spectra=spectra)
+    stack = network_stack(cc, template.offsets[channels], npos)
+
+    median = np.median(stack)
+    deviation = mad(stack)
+
+    if deviation == 0:
+        return None
+
+    normalized = (stack - median) / deviation
+    positions, _ = find_peaks(normalized, height=threshold,
+                              distance=max(template.npts, 1))
+
+    return positions, stack[positions], normalized[positions], len(channels)
+
+
+def _init_worker(templates):
+    _templates[:] = templates
+
+
+def _scan_templates(args):
+    indices, data, ids, threshold, min_channels = args
+
+    return [scan(_templates[k], data, ids, threshold,
+                 min_channels=min_channels) for k in indices]
+
+
+class MatchedFilterDetector(object):
+    """
+    template matching detector processing continuous data chunk by chunk.
+    The end of every chunk is kept to process the next one so the events
+    overlapping two consecutive chunks are detected.
+    :param templates: list of Template with the same sampling rate
+    :param threshold: detection threshold in multiple of the median absolute
+    deviation of the network stack, above its median
+    :param min_channels: minimum number of template channels present in the
+    data
+    :param workers: number of processes, the templates are spread across
+    the processes
+    """
+
+    def __init__(self, templates, threshold=8., min_channels=1, workers=1):
+        sampling_rates = set(template.sampling_rate for template in templates)
+
+        if len(sampling_rates) > 1:
+            raise ValueError('all the templates must have the same sampling '
+                             'rate')
+
+        self.templates = templates
+        self.sampling_rate = sampling_rates.pop() if templates else None
+        self.threshold = threshold
+        self.min_channels = min_channels
+        self.workers = workers
+
+        self.ids = sorted(set(tr_id for template in templates
+                              for tr_id in template.ids))
+        self.overlap = max([template.span for template in templates],
+                           default=1) - 1
+
+        self._tail = None
+        self._tail_end = None
+        self._last_detections = {}
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def reset(self):
+        """
+        forget the end of the previous chunk
+        """
+        self._tail = None
+        self._tail_end = None
+        self._last_detections = {}
+
+    def _buffer(self, stream):
+        """
+        return the data of the chunk preceded by the end of the previous
+        chunk if the chunk is contiguous with it
+        """
+
+        stream = Stream(traces=[tr for tr in stream
+                                if (tr.id in self.ids) and
+                                (tr.stats.sampling_rate == self.sampling_rate)])
+
+        if not len(stream):
+            return None, None
+
+        data, sr, t0, ids = stream.as_array(taplen=0,
+                                            sampling_rate=self.sampling_rate,
+                                            return_ids=True)
+
+        buffer = np.zeros((len(self.ids), data.shape[1]))
+        rows = [self.ids.index(tr_id) for tr_id in ids]
+        buffer[rows] = data
+
+        if self._tail is not None and \
+                abs(t0 - self._tail_end) < 0.5 / self.sampling_rate:
+            t0 -= self._tail.shape[1] / self.sampling_rate
+            buffer = np.hstack((self._tail, buffer))
+
+        self._tail = buffer[:, buffer.shape[1] - self.overlap:]
+        self._tail_end = t0 + buffer.shape[1] / self.sampling_rate
+
+        return buffer, t0
+
+    def process(self, stream):
+        """
+        detect the events in a chunk of continuous data
+        :param stream: chunk of continuous data
+        :type stream: ~uquake.core.stream.Stream
+        :return: list of detections sorted by time. Every detection is a
+        dictionary with the template name and index, the time of the
+        template start in the data, the network correlation, its value in
+        multiple of the MAD and the number of channels.
+        :rtype: list of dict
+        """
+
+        data, t0 = self._buffer(stream)
+
+        if data is None:
+            return []
+
+        if self.workers == 1:
+            results = [scan(template, data, self.ids, self.threshold,
+                            min_channels=self.min_channels)
+                       for template in self.templates]
+        else:
+            if self._executor is None:
+                # the templates are sent once to every process
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, initializer=_init_worker,
+                    initargs=(self.templates,))
+
+            groups = np.array_split(np.arange(len(self.templates)),
+                                    self.workers)
+            tasks = [(group, data, self.ids, self.threshold,
+                      self.min_channels) for group in groups if len(group)]
+            results = [result for group_results
+                       in self._executor.map(_scan_templates, tasks)
+                       for result in group_results]
+
+        detections = []
+
+        for k, (template, result) in enumerate(zip(self.templates, results)):
+            if result is None:
+                continue
+
+            min_separation = template.npts / self.sampling_rate
+
+            for position, value, mad_value in zip(*result[:3]):
+                time = t0 + position / self.sampling_rate
+
+                # detections repeated in the overlap of consecutive chunks
+                last = self._last_detections.get(k)
+
+                if last is not None and time - last < min_separation:
+                    continue
+
+                self._last_detections[k] = time
+                detections.append({'template': template.name,
+                                   'template_index': k,
+                                   'time': time,
+                                   'correlation': float(value),
+                                   'mad': float(mad_value),
+                                   'n_channels': result[3]})
+
+        return sorted(detections, key=lambda detection: detection['time'])
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------
+# Filename: energy.py
+#  Purpose: radiated seismic energy
+#   Author: uquake development team
+#    Email: devs@uquake.org
+#
+# Copyright (C) 2016 uquake development team
+# --------------------------------------------------------------------
+"""
+radiated seismic energy
+
+The P and S windows of all the traces of an event are cut from a common
+array (see uquake.waveform.source_parameters) and their velocity spectra
+computed with one 2-D real FFT. The squared spectra are corrected for the
+attenuation (the model of uquake.core.util.tools.attenuate), integrated,
+summed over the components of every sensor and converted to energy with
+the geometrical spreading and the radiation pattern of every sensor
+(Boatwright and Fletcher, 1984).
+
+example:
+
+>>> estimator = EnergyEstimator(vp=5000, vs=3000,
+...                             sensor_locations=locations)
+>>> estimator.process(event, stream)
+>>> event.preferred_magnitude().energy_joule
+
+:copyright:
+    uquake development team (devs@uquake.org)
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+import numpy as np
+from scipy.integrate import trapezoid
+
+from loguru import logger
+from . import mag_utils
+from .source_parameters import (AVERAGE_RADIATION, amplitude_spectra,
+                                arrival_times, estimate_catalog,
+                                phase_windows)
+
+
+def integrate_spectra(frequencies, spectra, band=None):
+    """
+    integral of the squared amplitude spectra over positive frequencies
+    times 2, the integral of the squared signals (Parseval)
+    :param frequencies: frequencies of the spectra
+    :param spectra: array of shape (nspec, nfreq)
+    :param band: (fmin, fmax) frequency band of the integral
+    :rtype: numpy.ndarray
+    """
+
+    if band is not None:
+        selected = (frequencies >= band[0]) & (frequencies <= band[1])
+        frequencies = frequencies[selected]
+        spectra = spectra[:, selected]
+
+    return 2 * trapezoid(spectra ** 2, frequencies, axis=1)
+
+
+class EnergyEstimator(object):
+    """
+    radiated energy estimator
+    :param vp: P-wave velocity at the source in m/s
+    :param vs: S-wave velocity at the source in m/s
+    :param density: density at the source in kg/m3
+    :param q_p: quality factor of the P waves
+    :param q_s: quality factor of the S waves
+    :param band: frequency band of the integral in Hz, up to 0.4 x the
+    Nyquist frequency if None
+    :param window_length: length of the P and S windows in second, the P
+    windows end at the S arrival
+    :param pre_pick: time before the arrivals in second
+    :param ground_motion: 'displacement', 'velocity' or 'acceleration'
+    :param free_surface: free surface amplification
+    :param min_radiation: minimum absolute radiation pattern of a sensor
+    when the focal mechanism is used, the sensors close to the nodal planes
+    are not over-corrected
+    :param sensor_locations: dictionary mapping the sensor codes to (x, y, z)
+    used for the sensors without ray
+    """
+
+    def __init__(self, vp, vs, density=2700., q_p=200., q_s=300., band=None,
+                 window_length=0.1, pre_pick=0.01, ground_motion='velocity',
+                 free_surface=2., min_radiation=0.2, sensor_locations=None):
+
+        self.velocities = {'P': vp, 'S': vs}
+        self.quality_factors = {'P': q_p, 'S': q_s}
+        self.density = density
+        self.band = band
+        self.window_length = window_length
+        self.pre_pick = pre_pick
+        self.ground_motion = ground_motion
+        self.free_surface = free_surface
+        self.min_radiation = min_radiation
+        self.sensor_locations = sensor_locations
+
+    def radiation(self, event, windows, phase):
+        """
+        radiation pattern of every window from the preferred focal mechanism
+        and the takeoff angles of the rays (see mag_utils.radiation_pattern).
+        The average radiation pattern is used for the windows without ray
+        or if the event has no focal mechanism.
+        :rtype: numpy.ndarray
+        """
+
+        radiation = np.full(len(windows['rays']), AVERAGE_RADIATION[phase])
+        focal_mechanism = event.preferred_focal_mechanism()
+
+        if focal_mechanism is None or focal_mechanism.nodal_planes is None:
+            return radiation
+
+        plane = focal_mechanism.nodal_planes.nodal_plane_1
+        known = np.array([ray is not None and ray.takeoff_angle is not None
+                          and ray.azimuth is not None
+                          for ray in windows['rays']])
+
+        if not known.any():
+            return radiation
+
+        rays = [ray for ray, k in zip(windows['rays'], known) if k]
+        values = mag_utils.radiation_pattern(
+            [ray.takeoff_angle for ray in rays],
+            [ray.azimuth for ray in rays], plane.strike, plane.dip,
+            plane.rake, phase=phase)
+        radiation[known] = np.maximum(np.abs(values), self.min_radiation)
+
+        return radiation
+
+    def phase_energy(self, event, stream, phase):
+        """
+        energy radiated by a phase estimated at every sensor
+        :return: energies in joule and sensor codes, None if the phase has
+        no window
+        :rtype: tuple(numpy.ndarray, numpy.ndarray)
+        """
+
+        velocity = self.velocities[phase]
+        windows = phase_windows(event, stream, phase, self.window_length,
+                                pre_pick=self.pre_pick,
+                                sensor_locations=self.sensor_locations,
+                                velocity=velocity)
+
+        if windows is None:
+            return None
+
+        data = windows['data']
+        sr = windows['sampling_rate']
+
+        if phase == 'P':
+            # the samples after the S arrival are not part of the P window
+            s_times = arrival_times(event, 'S')
+            p_times = arrival_times(event, 'P')
+            ends = np.array([
+                (s_times[sensor][0] - p_times[sensor][0] + self.pre_pick) * sr
+                if sensor in s_times and sensor in p_times else data.shape[1]
+                for sensor in windows['sensors']])
+            data = data * (np.arange(data.shape[1])[np.newaxis, :] <
+                           ends[:, np.newaxis])
+
+        frequencies, spectra = amplitude_spectra(
+            data, sr, ground_motion=self.ground_motion, output='velocity')
+
+        # attenuation correction, t* = distance / (velocity * Q) as in
+        # tools.attenuate
+        tstar = windows['distances'] / (velocity *
+                                        self.quality_factors[phase])
+        spectra *= np.exp(np.pi * frequencies[np.newaxis, :] *
+                          tstar[:, np.newaxis])
+
+        band = self.band or (frequencies[1], 0.4 * frequencies[-1])
+        fluxes = integrate_spectra(frequencies, spectra, band=band)
+
+        radiation = self.radiation(event, windows, phase)
+        energies = 4 * np.pi * self.density * velocity * \
+            windows['distances'] ** 2 * fluxes / \
+            (self.free_surface * radiation) ** 2 * \
+            AVERAGE_RADIATION[phase] ** 2
+
+        # the energies of the components of a sensor add up
+        sensors, index = np.unique(windows['sensors'], return_inverse=True)
+        sensor_energies = np.zeros(len(sensors))
+        np.add.at(sensor_energies, index, energies)
+
+        return sensor_energies, sensors
+
+    def estimate(self, event, stream):
+        """
+        estimate the energy radiated by an event
+        :return: dictionary with the P, S and total energies in joule and the
+        standard deviations of the log10 sensor energies, None if no phase
+        has a window
+        :rtype: dict
+        """
+
+        results = {}
+
+        for phase in ('P', 'S'):
+            energies = self.phase_energy(event, stream, phase)
+
+            if energies is None:
+                continue
+
+            log_energies = np.log10(energies[0][energies[0] > 0])
+
+            if not len(log_energies):
+                continue
+
+            results[f'energy_{phase.lower()}_joule'] = \
+                float(10 ** np.mean(log_energies))
+            results[f'energy_{phase.lower()}_std'] = \
+                float(np.std(log_energies))
+
+        if not results:
+            return None
+
+        results['energy_joule'] = results.get('energy_p_joule', 0) + \
+            results.get('energy_s_joule', 0)
+
+        return results
+
+    def process(self, event, stream):
+        """
+        estimate the energy radiated by an event and set the energy fields
+        of its preferred magnitude (the last magnitude if none is preferred)
+        :return: the results of estimate
+        :rtype: dict
+        """
+
+        return self._set_energy(event, self.estimate(event, stream))
+
+    @staticmethod
+    def _set_energy(event, results):
+        if results is None:
+            logger.debug(f'{event.resource_id}: no energy estimate')
+            return None
+
+        magnitude = event.preferred_magnitude() or \
+            (event.magnitudes[-1] if event.magnitudes else None)
+
+        if magnitude is None:
+            logger.warning(f'{event.resource_id}: no magnitude, the energy is '
+                           f'not set')
+            return results
+
+        for key, value in results.items():
+            setattr(magnitude, key, value)
+
+        return results
+
+    def process_catalog(self, catalog, streams, workers=1):
+        """
+        estimate the energy radiated by the events of a catalog
+        :param catalog: catalog
+        :param streams: waveforms of every event, a list aligned with the
+        catalog or a function returning the stream of an event
+        :param workers: number of processes
+        :return: the results of estimate for every event
+        :rtype: list
+        """
+
+        return estimate_catalog(self, catalog, streams, self._set_energy,
+                                workers=workers)
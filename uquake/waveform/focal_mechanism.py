@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------
+# Filename: focal_mechanism.py
+#  Purpose: focal mechanism grid search from polarities and amplitude ratios
+#   Author: uquake development team
+#    Email: devs@uquake.org
+#
+# Copyright (C) 2016 uquake development team
+# --------------------------------------------------------------------
+"""
+focal mechanism grid search from polarities and amplitude ratios
+
+The double couple radiation patterns of all the (strike, dip, rake) of a
+grid are evaluated for all the observations of an event at once with
+broadcast arrays. The mechanisms are processed in chunks, optionally on a
+pool of processes. The takeoff angles and azimuths are read from the rays
+of the origin or interpolated in the angle grids derived from the
+travel-time grids (see :func:`~uquake.core.grid.angles`).
+
+example:
+
+>>> catalog_focal_mechanisms(catalog, min_magnitude=0.5,
+...                          travel_time_grids=grids)
+>>> catalog[0].plot_focal_mechanism()
+
+:copyright:
+    uquake development team (devs@uquake.org)
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from obspy.core.event import (FocalMechanism, NodalPlane, NodalPlanes,
+                              ResourceIdentifier)
+
+from loguru import logger
+from . import mag_utils
+
+# default number of (mechanism, observation) evaluated in a chunk
+CHUNK_SIZE = 2 ** 21
+
+# observations shared with the worker processes, set by _init_worker
+_observations = {}
+
+
+def radiation_patterns(takeoff_angle, takeoff_azimuth, strike, dip, rake):
+    """
+    P, SV and SH radiation patterns of double couple sources, see
+    mag_utils.double_couple_components. The arguments are broadcast against
+    each other, all angles in degrees.
+    :rtype: tuple(numpy.ndarray, numpy.ndarray, numpy.ndarray)
+    """
+
+    return mag_utils.double_couple_components(takeoff_angle, takeoff_azimuth,
+                                              strike, dip, rake)
+
+
+def mechanism_grid(strike_step=5., dip_step=5., rake_step=5.):
+    """
+    return all the (strike, dip, rake) of a regular grid
+    :rtype: numpy.ndarray of shape (n, 3)
+    """
+
+    strikes = np.arange(0, 360, strike_step)
+    dips = np.arange(dip_step, 90 + dip_step / 2, dip_step)
+    rakes = np.arange(-180, 180, rake_step)
+
+    return np.array(np.meshgrid(strikes, dips, rakes,
+                                indexing='ij')).reshape(3, -1).T
+
+
+def grid_search(takeoff_angles, azimuths, polarities=None,
+                amplitude_ratios=None, weights=None, ratio_weight=1.,
+                mechanisms=None, tolerance=0.05, chunk_size=CHUNK_SIZE,
+                workers=1):
+    """
+    search the mechanisms fitting best the P polarities and S/P amplitude
+    ratios
+    :param takeoff_angles: takeoff angle of every observation in degrees (0
+    pointing down)
+    :param azimuths: takeoff azimuth of every observation in degrees
+    :param polarities: P polarity of every observation (1, -1 or 0/nan if
+    unknown)
+    :param amplitude_ratios: S/P amplitude ratio of every observation (nan if
+    unknown)
+    :param weights: weight of every observation
+    :param ratio_weight: weight of the amplitude ratio misfit (mean absolute
+    log10 ratio difference) relative to the polarity misfit (weighted
+    fraction of wrong polarities)
+    :param mechanisms: array of (strike, dip, rake), see mechanism_grid
+    :param tolerance: mechanisms with misfits within tolerance of the best are
+    returned as acceptable
+    :param chunk_size: number of (mechanism, observation) evaluated at once
+    :param workers: number of processes
+    :return: dictionary with the best strike, dip and rake, the misfit, the
+    number of wrong polarities and the acceptable mechanisms
+    :rtype: dict
+    """
+
+    n_obs = len(takeoff_angles)
+
+    if polarities is None:
+        polarities = np.full(n_obs, np.nan)
+
+    if amplitude_ratios is None:
+        amplitude_ratios = np.full(n_obs, np.nan)
+
+    if weights is None:
+        weights = np.ones(n_obs)
+
+    if mechanisms is None:
+        mechanisms = mechanism_grid()
+
+    polarities = np.nan_to_num(np.asarray(polarities, dtype=float))
+    amplitude_ratios = np.asarray(amplitude_ratios, dtype=float)
+
+    observations = {
+        'takeoff_angles': np.asarray(takeoff_angles, dtype=float),
+        'azimuths': np.asarray(azimuths, dtype=float),
+        'polarities': polarities,
+        'log_ratios': np.log10(np.where(amplitude_ratios > 0,
+                                        amplitude_ratios, np.nan)),
+        'weights': np.asarray(weights, dtype=float),
+        'ratio_weight': ratio_weight}
+
+    n_chunk = max(1, chunk_size // max(n_obs, 1))
+    chunks = [mechanisms[k:k + n_chunk]
+              for k in range(0, len(mechanisms), n_chunk)]
+
+    if workers == 1 or len(chunks) == 1:
+        _observations.update(observations)
+
+        try:
+            results = [_misfit(chunk) for chunk in chunks]
+        finally:
+            _observations.clear()
+    else:
+        # the observations are sent once to every process
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(observations,)) as executor:
+            results = list(executor.map(_misfit, chunks))
+
+    misfits = np.concatenate([result[0] for result in results])
+    wrong = np.concatenate([result[1] for result in results])
+
+    best = np.argmin(misfits)
+    acceptable = misfits <= misfits[best] + tolerance
+
+    return {'strike': mechanisms[best, 0],
+            'dip': mechanisms[best, 1],
+            'rake': mechanisms[best, 2],
+            'misfit': misfits[best],
+            'polarity_errors': int(wrong[best]),
+            'acceptable': mechanisms[acceptable]}
+
+
+def _init_worker(observations):
+    _observations.update(observations)
+
+
+def _misfit(mechanisms):
+    obs = _observations
+    strike, dip, rake = [mechanisms[:, [k]] for k in range(3)]
+
+    p, sv, sh = radiation_patterns(obs['takeoff_angles'][np.newaxis, :],
+                                   obs['azimuths'][np.newaxis, :],
+                                   strike, dip, rake)
+
+    weights = obs['weights']
+    polarities = obs['polarities']
+    known = polarities != 0
+
+    wrong = (np.sign(p) != polarities) & known
+    polarity_misfit = (wrong * weights).sum(axis=1) / \
+        max((weights * known).sum(), 1e-12)
+
+    misfit = polarity_misfit
+    log_ratios = obs['log_ratios']
+    ratios = np.isfinite(log_ratios)
+
+    if ratios.any():
+        predicted = np.log10(np.sqrt(sv[:, ratios] ** 2 + sh[:, ratios] ** 2)
+                             / np.maximum(np.abs(p[:, ratios]), 1e-3))
+        ratio_misfit = (np.abs(predicted - log_ratios[ratios]) *
+                        weights[ratios]).sum(axis=1) / weights[ratios].sum()
+        misfit = misfit + obs['ratio_weight'] * ratio_misfit
+
+    return misfit, wrong.sum(axis=1)
+
+
+class TakeoffAngles(object):
+    """
+    takeoff angles and azimuths from the angle grids derived from the
+    travel-time grids. The angle grids are computed once per sensor.
+    :param travel_time_grids: dictionary mapping (sensor code, phase) to the
+    travel-time Grid
+    """
+
+    def __init__(self, travel_time_grids, phase='P'):
+        self.travel_time_grids = dict(
+            (sensor, grid) for (sensor, grid_phase), grid
+            in travel_time_grids.items() if grid_phase == phase)
+        self._angles = {}
+
+    def __contains__(self, sensor):
+        return sensor in self.travel_time_grids
+
+    def __call__(self, sensor, location):
+        """
+        return the takeoff angle and azimuth in degrees for a source at
+        location
+        """
+        from ..core.grid import angles
+
+        if sensor not in self._angles:
+            self._angles[sensor] = angles(self.travel_time_grids[sensor])
+
+        azimuth, takeoff = self._angles[sensor]
+        location = np.asarray(location, dtype=float)
+
+        return np.degrees(takeoff.interpolate(location,
+                                              grid_coordinate=False)[0]), \
+            np.degrees(azimuth.interpolate(location,
+                                           grid_coordinate=False)[0])
+
+
+def event_observations(event, takeoff_angles=None):
+    """
+    return the takeoff angles, azimuths, P polarities and S/P amplitude
+    ratios (from the peak_vel of the arrivals) of the P arrivals of the
+    preferred origin
+    :param event: event
+    :param takeoff_angles: TakeoffAngles used for the sensors without ray
+    :rtype: tuple of numpy.ndarray
+    """
+
+    origin = event.preferred_origin() or event.origins[-1]
+    rays = dict(((ray.sensor_code, ray.phase), ray)
+                for ray in (origin.rays or []))
+
+    peak_velocities = {}
+    p_picks = {}
+
+    for arrival in origin.arrivals:
+        pick = arrival.get_pick()
+
+        if pick is None or pick.waveform_id is None:
+            continue
+
+        phase = (arrival.phase or pick.phase_hint or '').upper()
+        sensor = pick.sensor
+
+        if arrival.peak_vel is not None:
+            peak_velocities[(sensor, phase)] = abs(arrival.peak_vel)
+
+        if phase == 'P':
+            p_picks[sensor] = pick
+
+    rows = []
+
+    for sensor, pick in p_picks.items():
+        ray = rays.get((sensor, 'P')) or rays.get((pick.get_sta(), 'P'))
+
+        if ray is not None and ray.takeoff_angle is not None:
+            takeoff, azimuth = ray.takeoff_angle, ray.azimuth
+        elif takeoff_angles is not None:
+            code = sensor if sensor in takeoff_angles else pick.get_sta()
+
+            if code not in takeoff_angles:
+                continue
+            takeoff, azimuth = takeoff_angles(code, origin.loc)
+        else:
+            continue
+
+        polarity = {'positive': 1, 'negative': -1}.get(pick.polarity, 0)
+
+        ratio = np.nan
+
+        if (sensor, 'P') in peak_velocities and \
+                (sensor, 'S') in peak_velocities and \
+                peak_velocities[(sensor, 'P')] > 0:
+            ratio = peak_velocities[(sensor, 'S')] / \
+                peak_velocities[(sensor, 'P')]
+
+        rows.append((takeoff, azimuth, polarity, ratio))
+
+    if not rows:
+        return tuple(np.zeros(0) for _ in range(4))
+
+    return tuple(np.array(column, dtype=float) for column in zip(*rows))
+
+
+def event_focal_mechanism(event, takeoff_angles=None, min_polarities=8,
+                          **kwargs):
+    """
+    compute the focal mechanism of an event, append it to the focal
+    mechanisms of the event and set it as the preferred one
+    :param event: event
+    :param takeoff_angles: TakeoffAngles used for the sensors without ray
+    :param min_polarities: minimum number of P polarities
+    :param kwargs: see grid_search
+    :return: the focal mechanism, None if there are not enough polarities
+    :rtype: ~obspy.core.event.FocalMechanism
+    """
+    from obspy.imaging.beachball import aux_plane
+
+    takeoff, azimuth, polarities, ratios = event_observations(
+        event, takeoff_angles=takeoff_angles)
+
+    n_polarities = int(np.sum(polarities != 0))
+
+    if n_polarities < min_polarities:
+        logger.debug(f'{event.resource_id}: {n_polarities} polarities, '
+                     f'at least {min_polarities} are required')
+        return None
+
+    result = grid_search(takeoff, azimuth, polarities=polarities,
+                         amplitude_ratios=ratios, **kwargs)
+
+    strike, dip, rake = result['strike'], result['dip'], result['rake']
+    strike2, dip2, rake2 = aux_plane(strike, dip, rake)
+
+    nodal_planes = NodalPlanes(
+        nodal_plane_1=NodalPlane(strike=strike, dip=dip, rake=rake),
+        nodal_plane_2=NodalPlane(strike=float(strike2), dip=float(dip2),
+                                 rake=float(rake2)),
+        preferred_plane=1)
+
+    origin = event.preferred_origin() or event.origins[-1]
+    focal_mechanism = FocalMechanism(
+        nodal_planes=nodal_planes, triggering_origin_id=origin.resource_id,
+        station_polarity_count=n_polarities, misfit=result['misfit'],
+        method_id=ResourceIdentifier('grid_search'),
+        evaluation_mode='automatic')
+
+    event.focal_mechanisms.append(focal_mechanism)
+    event.preferred_focal_mechanism_id = focal_mechanism.resource_id.id
+
+    return focal_mechanism
+
+
+def catalog_focal_mechanisms(catalog, min_magnitude=None,
+                             travel_time_grids=None, **kwargs):
+    """
+    compute the focal mechanisms of the events of a catalog with a
+    magnitude larger or equal to min_magnitude
+    :param catalog: catalog
+    :param min_magnitude: magnitude threshold, all the events if None
+    :param travel_time_grids: dictionary mapping (sensor code, phase) to the
+    travel-time grids used for the sensors without ray
+    :param kwargs: see event_focal_mechanism and grid_search
+    :return: the focal mechanisms (None for the events without)
+    :rtype: list
+    """
+
+    takeoff_angles = None
+
+    if travel_time_grids is not None:
+        takeoff_angles = TakeoffAngles(travel_time_grids)
+
+    focal_mechanisms = []
+
+    for event in catalog:
+        magnitude = event.preferred_magnitude() or \
+            (event.magnitudes[-1] if event.magnitudes else None)
+
+        if min_magnitude is not None and \
+                (magnitude is None or magnitude.mag is None or
+                 magnitude.mag < min_magnitude):
+            focal_mechanisms.append(None)
+            continue
+
+        focal_mechanisms.append(event_focal_mechanism(
+            event, takeoff_angles=takeoff_angles, **kwargs))
+
+    return focal_mechanisms
@@ -3,7 +3,10 @@
 #warnings.simplefilter("ignore", UserWarning)
 #warnings.simplefilter("ignore")
 
+from functools import lru_cache
+
 import numpy as np
+from scipy.ndimage import map_coordinates
 
 
 def calc_static_stress_drop(Mw, fc, phase='S', v=3.5, use_brune=False):
@@ -13,39 +16,97 @@ def calc_static_stress_drop(Mw, fc, phase='S', v=3.5, use_brune=False):
     than the Madariaga values for fcP, fcS
 
     :param Mw: moment magnitude
-    :type Mw: float
+    :type Mw: float or numpy.ndarray
     :param fc: corner frequency [Hz]
-    :type fc: float
+    :type fc: float or numpy.ndarray
     :param phase: P or S phase
-    :type phase: string
+    :type phase: string or array of strings
     :param v: P or S velocity [km/s] at source
-    :type v: float
+    :type v: float or numpy.ndarray
     :param use_brune: If true --> use Brune's original scaling
     :type use_brune: boolean
     :returns: static stress drop [MPa]
-    :rtype: float
+    :rtype: float or numpy.ndarray
 
     """
 
     if use_brune:          # Use Brune scaling
         c = .375
     else:                  # Use Madariaga scaling
-        if phase == 'S':
-            c = .21
-        else:
-            c = .32
+        c = np.where(np.asarray(phase) == 'S', .21, .32)
 
-    v *= 1e5 # cm/s
+    v = np.asarray(v) * 1e5 # cm/s, the input is not modified
 
-    a = c * v / fc   # radius of circular fault from corner freq
+    a = c * v / np.asarray(fc)   # radius of circular fault from corner freq
 
-    logM0 = 3/2 * Mw + 9.1 # in N-m
+    logM0 = 3/2 * np.asarray(Mw) + 9.1 # in N-m
     M0 = 10**logM0 * 1e7   # dyn-cm
 
     stress_drop = 7./16. * M0 * (1/a) ** 3 # in dyn/cm^2
     stress_drop /= 10. # convert to Pa=N/m^2
 
-    return stress_drop / 1e6 # MPa
+    stress_drop = stress_drop / 1e6 # MPa
+
+    if np.ndim(stress_drop) == 0:
+        return float(stress_drop)
+
+    return stress_drop
+
+
+# shear modulus [Pa] used for the potency
+SHEAR_MODULUS = 29.5e9
+
+
+def seismic_moment(Mw):
+    """
+    Return the seismic moment [N.m] of moment magnitudes (scalar or array)
+    """
+    return 10 ** (3 * (np.asarray(Mw, dtype=float) + 6.02) / 2)
+
+
+def potency(Mw, mu=SHEAR_MODULUS):
+    """
+    Return the potency [m3] of moment magnitudes (scalar or array)
+    """
+    return seismic_moment(Mw) / mu
+
+
+def apparent_stress(energy, Mw, mu=SHEAR_MODULUS):
+    """
+    Return the apparent stress from the radiated energy [J] and the moment
+    magnitude (scalars or arrays)
+    """
+    return 2 * np.asarray(energy, dtype=float) / potency(Mw, mu=mu)
+
+
+def source_properties(Mw, fc=None, energy=None, mu=SHEAR_MODULUS,
+                      **kwargs):
+    """
+    Return the seismic moment, potency, apparent stress and static stress
+        drop of arrays of moment magnitudes, corner frequencies and radiated
+        energies in one pass. Missing values are nan and give nan.
+    kwargs are passed to calc_static_stress_drop
+    :rtype: dict of numpy.ndarray
+    """
+
+    Mw = np.asarray(Mw, dtype=float)
+    fc = np.full(Mw.shape, np.nan) if fc is None \
+        else np.asarray(fc, dtype=float)
+    energy = np.full(Mw.shape, np.nan) if energy is None \
+        else np.asarray(energy, dtype=float)
+
+    properties = {'seismic_moment': seismic_moment(Mw),
+                  'potency_m3': potency(Mw, mu=mu)}
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        properties['apparent_stress'] = 2 * energy / \
+            properties['potency_m3']
+        valid = fc > 0
+        properties['static_stress_drop_mpa'] = np.where(
+            valid, calc_static_stress_drop(Mw, np.where(valid, fc, 1.),
+                                           **kwargs), np.nan)
+
+    return properties
 
 
 cos= np.cos
@@ -53,55 +114,69 @@ sin= np.sin
 degs2rad = np.pi / 180.
 
 
-def double_couple_rad_pat(takeoff_angle, takeoff_azimuth, strike, dip, rake,
-                          phase='P'):
+def double_couple_components(takeoff_angle, takeoff_azimuth, strike, dip,
+                             rake, components=('P', 'SV', 'SH')):
     """
-    Return the radiation pattern value at the takeoff point (angle, azimuth) 
-        for a specified double couple source
+    Return the P, SV and SH radiation patterns at the takeoff points
+        (angle, azimuth) of a double couple source
         see Aki & Richards (4.89) - (4.91)
-    All input angles in degrees
-    allowable phase = ['P', 'SV', 'SH']
+    The arguments are broadcast against each other, all angles in degrees
+    :param components: radiation patterns returned, in order
+    :rtype: tuple(numpy.ndarray)
     """
 
-    fname = 'double_couple_rad_pat'
-    i_h = takeoff_angle * degs2rad
-    azd = (takeoff_azimuth - strike) * degs2rad
+    i_h = np.multiply(takeoff_angle, degs2rad)
+    azd = np.subtract(takeoff_azimuth, strike) * degs2rad
     # Below is the convention from Lay & Wallace - it looks wrong!
     #azd = (strike - takeoff_azimuth) * degs2rad
-    strike = strike * degs2rad
-    dip    = dip * degs2rad
-    rake   = rake * degs2rad
+    dip    = np.multiply(dip, degs2rad)
+    rake   = np.multiply(rake, degs2rad)
 
-    radpat = None
-    if phase == 'P':
-        radpat = cos(rake)*sin(dip)*sin(i_h)**2 * sin(2.*azd) \
+    radpats = {}
+    if 'P' in components:
+        radpats['P'] = cos(rake)*sin(dip)*sin(i_h)**2 * sin(2.*azd) \
                 -cos(rake)*cos(dip)*sin(2.*i_h) * cos(azd) \
                 +sin(rake)*sin(2.*dip)*(cos(i_h)**2 - \
                                         sin(i_h)**2 * sin(azd)**2) \
                 +sin(rake)*cos(2.*dip)*sin(2.*i_h)*sin(azd)
 
-    elif phase == 'SV':
-        radpat = sin(rake)*cos(2.*dip)*cos(2.*i_h) * sin(azd) \
+    if 'SV' in components:
+        radpats['SV'] = sin(rake)*cos(2.*dip)*cos(2.*i_h) * sin(azd) \
                 -cos(rake)*cos(dip)*cos(2.*i_h) * cos(azd) \
                 +0.5*cos(rake)*sin(dip)*sin(2.*i_h) * sin(2.*azd) \
                 -0.5*sin(rake)*sin(2.*dip)*sin(2.*i_h)*(1 + sin(azd)**2)
 
-    elif phase == 'SH':
-        radpat = cos(rake)*cos(dip)*cos(i_h) * sin(azd) \
+    if 'SH' in components:
+        radpats['SH'] = cos(rake)*cos(dip)*cos(i_h) * sin(azd) \
                 +cos(rake)*sin(dip)*sin(i_h) * cos(2.*azd) \
                 +sin(rake)*cos(2.*dip)*cos(i_h) * cos(azd) \
                 -0.5*sin(rake)*sin(2.*dip)*sin(i_h) * sin(2.*azd)
 
-    elif phase == 'S':
-        radpat_SV = sin(rake)*cos(2.*dip)*cos(2.*i_h) * sin(azd) \
-                   -cos(rake)*cos(dip)*cos(2.*i_h) * cos(azd) \
-                   +0.5*cos(rake)*sin(dip)*sin(2.*i_h) * sin(2.*azd) \
-                   -0.5*sin(rake)*sin(2.*dip)*sin(2.*i_h)*(1 + sin(azd)**2)
+    return tuple(radpats[component] for component in components)
+
+
+def double_couple_rad_pat(takeoff_angle, takeoff_azimuth, strike, dip, rake,
+                          phase='P'):
+    """
+    Return the radiation pattern value at the takeoff point (angle, azimuth) 
+        for a specified double couple source
+        see Aki & Richards (4.89) - (4.91) and double_couple_components
+    All input angles in degrees
+    allowable phase = ['P', 'SV', 'SH']
+    """
+
+    fname = 'double_couple_rad_pat'
+
+    radpat = None
+    if phase in ('P', 'SV', 'SH'):
+        radpat, = double_couple_components(takeoff_angle, takeoff_azimuth,
+                                           strike, dip, rake,
+                                           components=(phase,))
 
-        radpat_SH = cos(rake)*cos(dip)*cos(i_h) * sin(azd) \
-                   +cos(rake)*sin(dip)*sin(i_h) * cos(2.*azd) \
-                   +sin(rake)*cos(2.*dip)*cos(i_h) * cos(azd) \
-                   -0.5*sin(rake)*sin(2.*dip)*sin(i_h) * sin(2.*azd)
+    elif phase == 'S':
+        radpat_SV, radpat_SH = double_couple_components(
+            takeoff_angle, takeoff_azimuth, strike, dip, rake,
+            components=('SV', 'SH'))
 
         radpat = np.sqrt(radpat_SV**2 + radpat_SH**2)
 
@@ -144,7 +219,7 @@ def free_surface_displacement_amplification(inc_angle, vp, vs,
     elif incident_wave == 'SV':
         x1_amp = 2./vs*cosj/vs * a / Rpole
         x2_amp = 0.
-        x3_amp = 4./b * p * cosi/vp * cosj/vs / Rpole
+        x3_amp = 4./vs * p * cosi/vp * cosj/vs / Rpole
 
     elif incident_wave == 'SH':
         x1_amp = 0.
@@ -155,4 +230,136 @@ def free_surface_displacement_amplification(inc_angle, vp, vs,
               (fname, incident_wave))
         return None
 
-    return np.array([x1_amp, x2_amp, x3_amp])
\ No newline at end of file
+    # broadcast so arrays of incidence angles return an array of shape (3, n)
+    return np.array(np.broadcast_arrays(x1_amp, x2_amp, x3_amp, i)[:3])
+
+
+@lru_cache(maxsize=64)
+def radiation_pattern_table(strike, dip, rake, phase='P', step=1.):
+    """
+    Return the radiation pattern of a double couple source tabulated over
+        takeoff angles [0, 180] (rows) and takeoff azimuths [0, 360]
+        (columns) with a step in degrees. The tables are computed once per
+        set of parameters and are read-only.
+    All input angles in degrees
+    allowable phase = ['P', 'SV', 'SH', 'S']
+    """
+
+    takeoff_angles = np.linspace(0., 180., int(round(180. / step)) + 1)
+    azimuths = np.linspace(0., 360., int(round(360. / step)) + 1)
+
+    table = double_couple_rad_pat(takeoff_angles[:, np.newaxis],
+                                  azimuths[np.newaxis, :], strike, dip, rake,
+                                  phase=phase)
+
+    if table is None:
+        raise ValueError('unrecognized phase %s' % phase)
+
+    table.flags.writeable = False
+
+    return table
+
+
+def radiation_pattern(takeoff_angle, takeoff_azimuth, strike, dip, rake,
+                      phase='P', step=1.):
+    """
+    Return the radiation pattern values at the takeoff points (angles,
+        azimuths) for a specified double couple source, interpolated
+        (bilinear) in the table returned by radiation_pattern_table.
+        takeoff_angle and takeoff_azimuth can be arrays (e.g., all the
+        sensors of an event).
+    All input angles in degrees
+    """
+
+    table = radiation_pattern_table(float(strike), float(dip), float(rake),
+                                    phase=phase, step=float(step))
+
+    takeoff_angle = np.clip(np.asarray(takeoff_angle, dtype=float), 0., 180.)
+    takeoff_azimuth = np.mod(np.asarray(takeoff_azimuth, dtype=float), 360.)
+    takeoff_angle, takeoff_azimuth = np.broadcast_arrays(takeoff_angle,
+                                                         takeoff_azimuth)
+
+    coordinates = np.array([takeoff_angle.ravel(),
+                            takeoff_azimuth.ravel()]) / step
+    values = map_coordinates(table, coordinates, order=1, mode='nearest')
+
+    return values.reshape(takeoff_angle.shape)
+
+
+@lru_cache(maxsize=64)
+def free_surface_table(vp, vs, incident_wave='P', step=0.1):
+    """
+    Return the free surface displacement amplification (x1, x2, x3)
+        tabulated over incidence angles [0, 90] with a step in degrees,
+        array of shape (n, 3). The tables are computed once per set of
+        parameters and are read-only.
+    """
+
+    inc_angles = np.linspace(0., 90., int(round(90. / step)) + 1)
+    table = free_surface_displacement_amplification(
+        inc_angles, vp, vs, incident_wave=incident_wave)
+
+    if table is None:
+        raise ValueError('unrecognized incident wave %s' % incident_wave)
+
+    table = np.ascontiguousarray(table.T)
+    table.flags.writeable = False
+
+    return table
+
+
+def free_surface_amplification(inc_angle, vp, vs, incident_wave='P',
+                               step=0.1):
+    """
+    Returns free surface displacement amplification (x1, x2, x3) for
+        incident P/S waves interpolated (linear) in the table returned by
+        free_surface_table. inc_angle can be an array (e.g., all the sensors
+        of an event), the result has the shape inc_angle.shape + (3,).
+    All input angles in degrees
+    """
+
+    table = free_surface_table(float(vp), float(vs),
+                               incident_wave=incident_wave, step=float(step))
+
+    inc_angle = np.asarray(inc_angle, dtype=float)
+    position = np.clip(np.abs(inc_angle), 0., 90.).ravel() / step
+    index = np.minimum(position.astype(int), len(table) - 2)
+    fraction = (position - index)[:, np.newaxis]
+
+    values = table[index] * (1 - fraction) + table[index + 1] * fraction
+
+    return values.reshape(inc_angle.shape + (3,))
+
+
+def ray_corrections(rays, strike, dip, rake, vp, vs, phase='P', step=1.):
+    """
+    Return the radiation pattern and the free surface amplification (x1, x2,
+        x3) for a list of rays (uquake.core.event.Ray) in one array
+        operation. The rays without takeoff angle or incidence angle give
+        nan.
+    Ray takeoff angles and azimuths in degrees
+    """
+
+    takeoff_angles = np.array([np.nan if ray.takeoff_angle is None
+                               else ray.takeoff_angle for ray in rays],
+                              dtype=float)
+    azimuths = np.array([np.nan if ray.azimuth is None else ray.azimuth
+                         for ray in rays], dtype=float)
+    # the incidence angles of the rays are in radians
+    inc_angles = np.array([np.nan if ray.incidence_angle is None
+                           else np.degrees(ray.incidence_angle)
+                           for ray in rays], dtype=float)
+
+    known = np.isfinite(takeoff_angles) & np.isfinite(azimuths)
+    radiation = np.full(len(rays), np.nan)
+    radiation[known] = radiation_pattern(takeoff_angles[known],
+                                         azimuths[known], strike, dip, rake,
+                                         phase=phase, step=step)
+
+    incident_wave = 'P' if phase.upper() == 'P' else 'SV'
+    known = np.isfinite(inc_angles)
+    amplification = np.full((len(rays), 3), np.nan)
+    amplification[known] = free_surface_amplification(
+        inc_angles[known], vp, vs, incident_wave=incident_wave)
+
+    return radiation, amplification
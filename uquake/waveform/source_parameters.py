@@ -0,0 +1,553 @@
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------
+# Filename: source_parameters.py
+#  Purpose: spectral source parameters (corner frequency, moment magnitude)
+#   Author: uquake development team
+#    Email: devs@uquake.org
+#
+# Copyright (C) 2016 uquake development team
+# --------------------------------------------------------------------
+"""
+spectral source parameters (corner frequency, moment magnitude)
+
+The P and S windows of all the traces of an event are cut from a common
+array and transformed with one 2-D real FFT. The displacement spectra,
+corrected for the geometrical spreading and the attenuation, are fitted
+with Brune or Boatwright source models by a grid search over the corner
+frequency evaluated for all the spectra at once; the low frequency plateau
+minimizing the log misfit has a closed form. Events can be processed on a
+pool of processes.
+
+example:
+
+>>> estimator = SourceParameterEstimator(vp=5000, vs=3000,
+...                                      sensor_locations=locations)
+>>> magnitudes = estimator.process_catalog(catalog, streams, workers=4)
+
+:copyright:
+    uquake development team (devs@uquake.org)
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from obspy.core.event import ResourceIdentifier
+from scipy.signal.windows import tukey
+
+from loguru import logger
+from ..core.event import Magnitude
+from ..core.util import spectral
+
+# (gamma, n) of the source models
+# omega(f) = omega0 / (1 + (f / fc) ** (gamma * n)) ** (1 / gamma)
+SOURCE_MODELS = {'brune': (1, 2),
+                 'boatwright': (2, 2)}
+
+# average radiation patterns (Boore and Boatwright, 1984)
+AVERAGE_RADIATION = {'P': 0.52, 'S': 0.63}
+
+# estimator used by the worker processes, set by _init_worker
+_estimator = []
+
+
+def moment_to_magnitude(seismic_moment):
+    """
+    moment magnitude from the seismic moment in N.m, inverse of
+    Magnitude.seismic_moment
+    """
+    return 2 / 3 * np.log10(seismic_moment) - 6.02
+
+
+def arrival_times(event, phase):
+    """
+    return the arrival time and the ray (None if unknown) of a phase for
+    every sensor (station + location codes). The times are read from the
+    picks of the arrivals of the preferred origin, the sensors without pick
+    use the travel time of their ray.
+    :rtype: dict
+    """
+
+    origin = event.preferred_origin() or event.origins[-1]
+    rays = dict(((ray.sensor_code, ray.phase), ray)
+                for ray in (origin.rays or []))
+
+    times = {}
+
+    for arrival in origin.arrivals:
+        pick = arrival.get_pick()
+
+        if pick is None or pick.waveform_id is None:
+            continue
+
+        if (arrival.phase or pick.phase_hint or '').upper() != phase:
+            continue
+
+        ray = rays.get((pick.sensor, phase)) or \
+            rays.get((pick.get_sta(), phase))
+        times[pick.sensor] = (pick.time, ray)
+
+    for (sensor, ray_phase), ray in rays.items():
+        if ray_phase != phase or sensor in times:
+            continue
+
+        if ray.travel_time is not None:
+            times[sensor] = (origin.time + ray.travel_time, ray)
+
+    return times
+
+
+def phase_windows(event, stream, phase, window_length, pre_pick=0.01,
+                  sampling_rate=None, sensor_locations=None, velocity=None):
+    """
+    cut the windows of a phase for all the traces of an event
+    :param event: event with a preferred origin
+    :param stream: waveforms of the event
+    :type stream: ~uquake.core.stream.Stream
+    :param phase: 'P' or 'S'
+    :param window_length: length of the windows in second
+    :param pre_pick: time before the arrival in second
+    :param sampling_rate: sampling rate of the windows, the highest sampling
+    rate of the stream if None
+    :param sensor_locations: dictionary mapping the sensor codes to (x, y, z)
+    used for the distances of the sensors without ray
+    :param velocity: velocity used for the distances of the sensors without
+    ray or location
+    :return: dictionary with the windows (array of shape (nwin, npts)), the
+    sampling rate, the trace ids, the sensor codes, the rays (None if
+    unknown), the travel times and the hypocentral distances of the windows.
+    None if no window can be cut.
+    :rtype: dict
+    """
+
+    origin = event.preferred_origin() or event.origins[-1]
+    times = arrival_times(event, phase)
+
+    if not times or not len(stream):
+        return None
+
+    data, sr, t0, ids = stream.as_array(taplen=0,
+                                        sampling_rate=sampling_rate,
+                                        return_ids=True)
+    npts = int(round(window_length * sr))
+
+    rows = []
+    starts = []
+    sensors = []
+    window_rays = []
+    travel_times = []
+    distances = []
+
+    for row, trace_id in enumerate(ids):
+        network, station, location, channel = trace_id.split('.')
+        sensor = station + location
+
+        if sensor not in times:
+            if station not in times:
+                continue
+            sensor = station
+
+        time, ray = times[sensor]
+        start = int(round((time - pre_pick - t0) * sr))
+
+        if start < 0 or start >= data.shape[1]:
+            continue
+
+        travel_time = time - origin.time
+
+        if ray is not None and len(ray.nodes) > 1:
+            distance = ray.length
+        elif sensor_locations is not None and sensor in sensor_locations:
+            distance = np.linalg.norm(np.asarray(sensor_locations[sensor]) -
+                                      origin.loc)
+        elif velocity is not None:
+            distance = travel_time * velocity
+        else:
+            continue
+
+        rows.append(row)
+        starts.append(start)
+        sensors.append(sensor)
+        window_rays.append(ray)
+        travel_times.append(travel_time)
+        distances.append(distance)
+
+    if not rows:
+        return None
+
+    # zero padded so the windows running past the end of the data have npts
+    padded = np.zeros((len(rows), data.shape[1] + npts), dtype=data.dtype)
+    padded[:, :data.shape[1]] = data[rows]
+    windows = padded[np.arange(len(rows))[:, np.newaxis],
+                     np.array(starts)[:, np.newaxis] + np.arange(npts)]
+
+    return {'data': windows - windows.mean(axis=1, keepdims=True),
+            'sampling_rate': sr,
+            'ids': [ids[row] for row in rows],
+            'sensors': sensors,
+            'rays': window_rays,
+            'travel_times': np.array(travel_times),
+            'distances': np.maximum(np.array(distances, dtype=float), 1e-3)}
+
+
+def amplitude_spectra(windows, sampling_rate, ground_motion='velocity',
+                      output='displacement', workers=None):
+    """
+    amplitude spectra of the rows of windows (one 2-D real FFT)
+    :param windows: array of shape (nwin, npts)
+    :param sampling_rate: sampling rate of the windows
+    :param ground_motion: ground motion of the windows, 'displacement',
+    'velocity' or 'acceleration'
+    :param output: ground motion of the spectra
+    :return: frequencies and spectra in unit of the output ground motion x
+    second
+    :rtype: tuple(numpy.ndarray, numpy.ndarray)
+    """
+
+    npts = windows.shape[-1]
+    # the onset is close to the start of the window, only the ends are tapered
+    taper = tukey(npts, alpha=0.1)
+    nfft = spectral.fast_length(npts)
+
+    frequencies = spectral.rfftfreq(nfft, sampling_rate)
+    spectra = np.abs(spectral.rfft(windows * taper, n=nfft,
+                                   workers=workers)) / sampling_rate
+
+    orders = {'displacement': 0, 'velocity': 1, 'acceleration': 2}
+    order = orders[ground_motion] - orders[output]
+
+    if order > 0:
+        omega = 2 * np.pi * frequencies
+        omega[0] = np.inf
+        spectra /= omega ** order
+    elif order < 0:
+        spectra *= (2 * np.pi * frequencies) ** -order
+
+    return frequencies, spectra
+
+
+def displacement_spectra(windows, sampling_rate, ground_motion='velocity',
+                         workers=None):
+    """
+    amplitude displacement spectra of the rows of windows, see
+    amplitude_spectra
+    :rtype: tuple(numpy.ndarray, numpy.ndarray)
+    """
+
+    return amplitude_spectra(windows, sampling_rate,
+                             ground_motion=ground_motion,
+                             output='displacement', workers=workers)
+
+
+def source_spectrum(frequencies, corner_frequencies, model='brune'):
+    """
+    source model normalized to a unit plateau for every corner frequency
+    :return: array of shape (len(corner_frequencies), len(frequencies))
+    :rtype: numpy.ndarray
+    """
+
+    gamma, n = SOURCE_MODELS[model]
+    ratio = frequencies[np.newaxis, :] / \
+        np.asarray(corner_frequencies)[:, np.newaxis]
+
+    return 1 / (1 + ratio ** (gamma * n)) ** (1 / gamma)
+
+
+def fit_spectra(frequencies, spectra, corner_frequencies, model='brune',
+                band=None, weights=None):
+    """
+    fit source models to spectra with a grid search over the corner
+    frequency. For every corner frequency, the plateau minimizing the
+    squared log residuals is the mean log ratio of the spectra to the model.
+    :param frequencies: frequencies of the spectra
+    :param spectra: array of shape (nspec, nfreq)
+    :param corner_frequencies: corner frequencies searched
+    :param model: 'brune' or 'boatwright'
+    :param band: (fmin, fmax) frequency band of the fit
+    :param weights: weight of every spectrum in the joint corner frequency
+    :return: dictionary with the corner frequency common to all the spectra,
+    the plateaus for this corner frequency, the corner frequency fitting
+    every spectrum alone and the misfits (array of shape (nfc, nspec))
+    :rtype: dict
+    """
+
+    if band is None:
+        band = (frequencies[1], frequencies[-1])
+
+    selected = (frequencies >= band[0]) & (frequencies <= band[1])
+    log_spectra = np.log10(np.maximum(spectra[:, selected], 1e-300))
+    log_models = np.log10(source_spectrum(frequencies[selected],
+                                          corner_frequencies, model=model))
+
+    if weights is None:
+        weights = np.ones(len(spectra))
+
+    # residuals of shape (nfc, nspec, nfreq)
+    residuals = log_spectra[np.newaxis, :, :] - log_models[:, np.newaxis, :]
+    log_plateaus = residuals.mean(axis=2)
+    residuals -= log_plateaus[:, :, np.newaxis]
+    misfits = np.mean(residuals ** 2, axis=2)
+
+    best = np.argmin(weights @ misfits.T)
+    individual = np.argmin(misfits, axis=0)
+
+    return {'corner_frequency': corner_frequencies[best],
+            'plateaus': 10 ** log_plateaus[best],
+            'corner_frequencies': corner_frequencies[individual],
+            'misfits': misfits}
+
+
+class SourceParameterEstimator(object):
+    """
+    spectral source parameter estimator
+    :param vp: P-wave velocity at the source in m/s
+    :param vs: S-wave velocity at the source in m/s
+    :param density: density at the source in kg/m3
+    :param q_p: quality factor of the P waves
+    :param q_s: quality factor of the S waves
+    :param model: source model, 'brune' or 'boatwright'
+    :param fc_range: range of the corner frequencies searched in Hz
+    :param n_fc: number of corner frequencies (log spaced)
+    :param band: frequency band of the fit in Hz, up to 0.4 x the Nyquist
+    frequency if None
+    :param window_length: length of the P and S windows in second
+    :param pre_pick: time before the arrivals in second
+    :param phases: phases used
+    :param ground_motion: 'displacement', 'velocity' or 'acceleration'
+    :param free_surface: free surface amplification
+    :param sensor_locations: dictionary mapping the sensor codes to (x, y, z)
+    used for the sensors without ray
+    """
+
+    def __init__(self, vp, vs, density=2700., q_p=200., q_s=300.,
+                 model='brune', fc_range=(1., 1000.), n_fc=200, band=None,
+                 window_length=0.1, pre_pick=0.01, phases=('P', 'S'),
+                 ground_motion='velocity', free_surface=2.,
+                 sensor_locations=None):
+
+        if model not in SOURCE_MODELS:
+            raise ValueError(f'unknown source model {model}')
+
+        self.velocities = {'P': vp, 'S': vs}
+        self.quality_factors = {'P': q_p, 'S': q_s}
+        self.density = density
+        self.model = model
+        self.corner_frequencies = np.logspace(np.log10(fc_range[0]),
+                                              np.log10(fc_range[1]), n_fc)
+        self.band = band
+        self.window_length = window_length
+        self.pre_pick = pre_pick
+        self.phases = phases
+        self.ground_motion = ground_motion
+        self.free_surface = free_surface
+        self.sensor_locations = sensor_locations
+
+    def corrected_spectra(self, event, stream, phase):
+        """
+        displacement spectra of a phase corrected for the geometrical
+        spreading and the attenuation, the component spectra of a sensor are
+        combined (vector sum)
+        :return: frequencies, spectra (array of shape (nsensor, nfreq)) and
+        sensor codes, None if the phase has no window
+        """
+
+        windows = phase_windows(event, stream, phase, self.window_length,
+                                pre_pick=self.pre_pick,
+                                sensor_locations=self.sensor_locations,
+                                velocity=self.velocities[phase])
+
+        if windows is None:
+            return None
+
+        frequencies, spectra = displacement_spectra(
+            windows['data'], windows['sampling_rate'],
+            ground_motion=self.ground_motion)
+
+        # t* = travel time / Q for every window
+        tstar = windows['travel_times'] / self.quality_factors[phase]
+        spectra *= np.exp(np.pi * frequencies[np.newaxis, :] *
+                          tstar[:, np.newaxis])
+        spectra *= windows['distances'][:, np.newaxis]
+
+        sensors, index = np.unique(windows['sensors'], return_inverse=True)
+        power = np.zeros((len(sensors), len(frequencies)))
+        np.add.at(power, index, spectra ** 2)
+
+        return frequencies, np.sqrt(power), sensors
+
+    def estimate(self, event, stream):
+        """
+        estimate the source parameters of an event
+        :param event: event with a preferred origin and picks or rays
+        :param stream: waveforms of the event
+        :return: dictionary with the corner frequency and moment of every
+        phase and the combined moment magnitude, None if no phase can be
+        fitted
+        :rtype: dict
+        """
+
+        results = {}
+        moments = []
+
+        for phase in self.phases:
+            spectra = self.corrected_spectra(event, stream, phase)
+
+            if spectra is None:
+                continue
+
+            frequencies, spectra, sensors = spectra
+            band = self.band or (frequencies[1], 0.4 * frequencies[-1])
+            fit = fit_spectra(frequencies, spectra, self.corner_frequencies,
+                              model=self.model, band=band)
+
+            velocity = self.velocities[phase]
+            sensor_moments = 4 * np.pi * self.density * velocity ** 3 * \
+                fit['plateaus'] / (AVERAGE_RADIATION[phase] *
+                                   self.free_surface)
+
+            results[phase] = {
+                'corner_frequency': fit['corner_frequency'],
+                'corner_frequency_error': np.std(fit['corner_frequencies']),
+                'seismic_moment': 10 ** np.mean(np.log10(sensor_moments)),
+                'magnitude_error': np.std(moment_to_magnitude(
+                    sensor_moments)),
+                'n_sensors': len(sensors)}
+            moments.append(sensor_moments)
+
+        if not results:
+            return None
+
+        moments = np.concatenate(moments)
+        magnitudes = moment_to_magnitude(moments)
+        results['moment_magnitude'] = float(np.mean(magnitudes))
+        results['moment_magnitude_uncertainty'] = float(np.std(magnitudes))
+
+        return results
+
+    def magnitude(self, event, results):
+        """
+        magnitude from the results of estimate
+        :rtype: ~uquake.core.event.Magnitude
+        """
+
+        origin = event.preferred_origin() or event.origins[-1]
+        mw = results['moment_magnitude']
+
+        magnitude = Magnitude(
+            mag=mw, magnitude_type='Mw', origin_id=origin.resource_id,
+            method_id=ResourceIdentifier(f'spectral_{self.model}'),
+            evaluation_mode='automatic', moment_magnitude=mw,
+            frequency_domain_moment_magnitude=mw,
+            moment_magnitude_uncertainty=results[
+                'moment_magnitude_uncertainty'],
+            station_count=sum(results[phase]['n_sensors']
+                              for phase in self.phases if phase in results))
+
+        for phase in ('P', 'S'):
+            if phase in results:
+                setattr(magnitude, f'corner_frequency_{phase.lower()}_hz',
+                        results[phase]['corner_frequency'])
+
+        # the S corner frequency is preferred
+        phase = 'S' if 'S' in results else 'P'
+        magnitude.corner_frequency_hz = results[phase]['corner_frequency']
+        magnitude.corner_frequency_error = \
+            results[phase]['corner_frequency_error']
+
+        return magnitude
+
+    def process(self, event, stream):
+        """
+        estimate the source parameters of an event, append the magnitude to
+        the event and set it as the preferred magnitude
+        :return: the magnitude, None if it cannot be estimated
+        :rtype: ~uquake.core.event.Magnitude
+        """
+
+        results = self.estimate(event, stream)
+
+        return self._set_magnitude(event, results)
+
+    def _set_magnitude(self, event, results):
+        if results is None:
+            logger.debug(f'{event.resource_id}: no source parameters')
+            return None
+
+        magnitude = self.magnitude(event, results)
+        event.magnitudes.append(magnitude)
+        event.preferred_magnitude_id = magnitude.resource_id.id
+
+        return magnitude
+
+    def process_catalog(self, catalog, streams, workers=1):
+        """
+        estimate the source parameters of the events of a catalog
+        :param catalog: catalog
+        :param streams: waveforms of every event, a list aligned with the
+        catalog or a function returning the stream of an event
+        :param workers: number of processes
+        :return: the magnitudes (None for the events without)
+        :rtype: list
+        """
+
+        return estimate_catalog(self, catalog, streams, self._set_magnitude,
+                                workers=workers)
+
+
+def estimate_catalog(estimator, catalog, streams, set_results, workers=1):
+    """
+    estimate the events of a catalog with estimator.estimate, in the current
+    process or on a pool of processes. On both paths the error raised by an
+    event is logged and its results are None.
+    :param estimator: estimator with an estimate(event, stream) method (e.g.,
+    SourceParameterEstimator or energy.EnergyEstimator)
+    :param catalog: catalog
+    :param streams: waveforms of every event, a list aligned with the
+    catalog or a function returning the stream of an event
+    :param set_results: function taking an event and its results, called in
+    the current process for every event
+    :param workers: number of processes
+    :return: the values returned by set_results
+    :rtype: list
+    """
+
+    if callable(streams):
+        streams = map(streams, catalog)
+
+    tasks = zip(catalog, streams)
+
+    if workers == 1:
+        results = [_estimate(task, estimator=estimator) for task in tasks]
+    else:
+        # the estimator is sent once to every process
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(estimator,)) as executor:
+            results = list(executor.map(_estimate, tasks))
+
+    return [set_results(event, result)
+            for event, result in zip(catalog, results)]
+
+
+def _init_worker(estimator):
+    _estimator[:] = [estimator]
+
+
+def _estimate(task, estimator=None):
+    """
+    estimate an event with the estimator (the estimator of the worker
+    process if None), the errors are logged and None is returned
+    """
+
+    event, stream = task
+
+    if estimator is None:
+        estimator = _estimator[0]
+
+    try:
+        return estimator.estimate(event, stream)
+    except Exception as e:
+        logger.error(f'{event.resource_id}: {e}')
+        return None